@@ -0,0 +1,60 @@
+"""Reports password hashes per second for each hashing configuration.
+
+    python -m benchmarks.hasher [--seconds 5] [--processes 0 2 4]
+"""
+import argparse
+import hashlib
+import threading
+import time
+
+from wire.utils import Hasher
+
+CONFIGURATIONS = [
+    ('w', 16),
+    ('p', 15),
+    ('p', 16),
+    ('s', 14),
+]
+
+
+def bench(algorithm, strength, processes, seconds):
+    """Hashes from one thread per process, as concurrent requests would."""
+    Hasher.processes = processes
+    h = Hasher(strength=strength, algorithm=algorithm)
+    h.hash('warm up the pool')
+    counts = []
+    started = time.time()
+
+    def work():
+        count = 0
+        while time.time() - started < seconds:
+            h.hash('correct horse battery staple')
+            count += 1
+        counts.append(count)
+
+    threads = [threading.Thread(target=work)
+        for i in range(max(processes, 1))]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return sum(counts) / (time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--processes', type=int, nargs='+', default=[0, 2])
+    args = parser.parse_args()
+
+    print '%-10s %8s %9s %12s' % ('algorithm', 'strength', 'processes',
+        'hashes/sec')
+    for algorithm, strength in CONFIGURATIONS:
+        if algorithm == 's' and not hasattr(hashlib, 'scrypt'):
+            continue
+        for processes in args.processes:
+            rate = bench(algorithm, strength, processes, args.seconds)
+            print '%-10s %8d %9d %12.2f' % (algorithm, strength, processes,
+                rate)
+
+
+if __name__ == '__main__':
+    main()
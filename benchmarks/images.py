@@ -0,0 +1,68 @@
+"""Reports uploaded images resized per second for each pool size.
+
+    python -m benchmarks.images [--images 40] [--processes 1 2 4]
+
+Needs ImageMagick's convert, which also makes the source images.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from wire import images
+from wire.images import ImageProcessor
+
+
+def make_source(path, size):
+    subprocess.check_call(['convert', '-size', size, 'plasma:fractal', path])
+
+
+def bench(source, count, processes, workdir):
+    """Stages ``count`` copies of ``source`` as avatars, as a burst of
+    uploads would, and waits for the pool to resize them all."""
+    ImageProcessor.processes = processes
+    ImageProcessor.staging = os.path.join(workdir, 'staging')
+    dest = os.path.join(workdir, 'avatars-%d' % processes)
+    os.makedirs(dest)
+    placeholder = os.path.join(workdir, 'placeholder.png')
+    shutil.copyfile(source, placeholder)
+
+    done = images.stats()['processed'] + images.stats()['failed']
+    started = time.time()
+    for i in range(count):
+        upload = os.path.join(dest, 'upload-%d.jpg' % i)
+        shutil.copyfile(source, upload)
+        images.stage(upload, dest, images.AVATAR_SIZES, placeholder)
+    while images.stats()['processed'] + images.stats()['failed'] < \
+            done + count:
+        time.sleep(0.01)
+    return count / (time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--size', default='1600x1200')
+    parser.add_argument('--processes', type=int, nargs='+',
+        default=[1, 2, 4])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, 'source.jpg')
+        make_source(source, args.size)
+        print '%9s %12s' % ('processes', 'images/sec')
+        for processes in args.processes:
+            rate = bench(source, args.images, processes, workdir)
+            print '%9d %12.2f' % (processes, rate)
+        failed = images.stats()['failed']
+        if failed:
+            print '%d images failed to resize.' % failed
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""Replays a mix of requests against the app at rising concurrency.
+
+    python -m benchmarks.load [--url http://127.0.0.1:8000]
+        [--concurrency 1 2 4 8 16 32] [--seconds 10]
+        [--mix timeline=30 inbox=15 post=10] [--output curve.json]
+
+Each virtual user logs in as one of the users made by
+``benchmarks.populate`` and then makes requests back to back, picking each
+from the mix by weight. Without ``--url`` the requests go through Flask's
+test client in this process, which shows what the code costs; with it they
+go to an app already running there, such as a local gunicorn, which shows
+what a deployment can take. Either way the database is the one the app is
+configured with, which the users, threads and events are picked from.
+
+For each concurrency, throughput and latency percentiles are printed as
+they are measured, and the whole curve is written as JSON to ``--output``.
+"""
+import argparse
+import cookielib
+import json
+import random
+import sys
+import threading
+import urllib
+import urllib2
+from timeit import default_timer
+
+import redis
+
+from wire import create_app
+from benchmarks.suite import PASSWORD, percentile
+
+
+def timeline(user):
+    return 'GET', '/timeline', None
+
+
+def mentions(user):
+    return 'GET', '/mentions', None
+
+
+def profile(user):
+    return 'GET', '/user/%s' % user.population.username(), None
+
+
+def inbox(user):
+    return 'GET', '/inbox', None
+
+
+def thread(user):
+    if not user.threads:
+        return inbox(user)
+    return 'GET', '/thread/%s' % user.random.choice(user.threads), None
+
+
+def events(user):
+    return 'GET', '/events', None
+
+
+def event(user):
+    if not user.population.events:
+        return events(user)
+    return 'GET', '/event/%s' % user.random.choice(
+        user.population.events), None
+
+
+def search(user):
+    username = user.population.username()
+    return 'GET', '/async/contact/search/%s' % username[:user.random.randint(
+        1, len(username))], None
+
+
+def post(user):
+    return 'POST', '/post-update', {
+        'text': 'Load testing #load @%s' % user.population.username(),
+        'respond': ''
+    }
+
+
+def reply(user):
+    if not user.threads:
+        return inbox(user)
+    return 'POST', '/thread/%s' % user.random.choice(user.threads), {
+        'action': 'reply',
+        'content': 'A reply made while load testing.'
+    }
+
+
+REQUESTS = dict((f.__name__, f) for f in [timeline, mentions, profile,
+    inbox, thread, events, event, search, post, reply])
+MIX = ['timeline=30', 'mentions=5', 'profile=10', 'inbox=15', 'thread=10',
+    'events=5', 'event=5', 'search=5', 'post=10', 'reply=5']
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        """Returns the response's status and where it redirects to."""
+        response = self.client.open(path, method=method, data=data)
+        # Render the whole body, as a server would.
+        response.data
+        return response.status_code, response.headers.get('Location', '')
+
+
+class NoRedirect(urllib2.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+class HTTPClient:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.opener = urllib2.build_opener(NoRedirect,
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+
+    def request(self, method, path, data=None):
+        if data is not None:
+            data = urllib.urlencode(data)
+        try:
+            response = self.opener.open(self.url + path, data)
+            response.read()
+            return response.getcode(), ''
+        except urllib2.HTTPError as e:
+            return e.code, e.headers.get('Location', '')
+
+
+class Population:
+    """The users and events there are to pick from."""
+    def __init__(self, r, users):
+        self.r = r
+        self.usernames = r.lrange('list:usernames', 0, users - 1)
+        self.events = r.lrange('_list:events', 0, 199)
+        if not self.usernames:
+            raise RuntimeError('No users; run benchmarks.populate first.')
+
+    def username(self):
+        return random.choice(self.usernames)
+
+
+class VirtualUser:
+    def __init__(self, population, client, mix, seed):
+        self.population = population
+        self.client = client
+        self.random = random.Random(seed)
+        self.mix = mix
+        self.total = sum(weight for name, weight in mix)
+
+        self.username = self.random.choice(population.usernames)
+        r = population.r
+        key = r.get('username:%s' % self.username)
+        self.threads = r.zrevrange('user:%s:inbox' % key, 0, 29)
+
+    def login(self):
+        status, location = self.client.request('POST', '/login', {
+            'username': self.username,
+            'password': PASSWORD,
+            'uri': '/timeline'
+        })
+        if not location.endswith('/timeline'):
+            raise RuntimeError("Couldn't log in as %s." % self.username)
+
+    def choose(self):
+        point = self.random.random() * self.total
+        for name, weight in self.mix:
+            point -= weight
+            if point < 0:
+                return name
+        return self.mix[-1][0]
+
+    def run(self, until, results):
+        while default_timer() < until:
+            name = self.choose()
+            method, path, data = REQUESTS[name](self)
+            started = default_timer()
+            try:
+                status, location = self.client.request(method, path, data)
+            except IOError:
+                status = None
+            results.append((name, default_timer() - started,
+                status is not None and status < 400))
+
+
+def measure(population, make_client, mix, concurrency, seconds, seed):
+    users = [VirtualUser(population, make_client(), mix, seed + i)
+        for i in range(concurrency)]
+    for user in users:
+        user.login()
+
+    results = []
+    until = default_timer() + seconds
+    threads = [threading.Thread(target=user.run, args=(until, results))
+        for user in users]
+    started = default_timer()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    elapsed = default_timer() - started
+
+    latencies = sorted(latency for name, latency, ok in results)
+    by_request = {}
+    for name, latency, ok in results:
+        by_request.setdefault(name, []).append(latency)
+    return {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': len([ok for name, latency, ok in results if not ok]),
+        'requests_per_sec': len(results) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'p50_ms_by_request': dict((name, percentile(sorted(l), 0.5) * 1000)
+            for name, l in by_request.items())
+    }
+
+
+def parse_mix(mix):
+    parsed = []
+    for item in mix:
+        name, weight = item.split('=')
+        if name not in REQUESTS:
+            raise ValueError('Unknown request %s, pick from %s.' % (name,
+                ', '.join(sorted(REQUESTS))))
+        parsed.append((name, float(weight)))
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url',
+        help='load a running app instead of the test client')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+        default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--users', type=int, default=1000,
+        help='log in as one of the newest this many users')
+    parser.add_argument('--mix', nargs='+', default=MIX,
+        help='request=weight, from %s' % ', '.join(sorted(REQUESTS)))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    app = create_app()
+    app.config['TESTING'] = True
+    population = Population(redis.Redis(connection_pool=app.redis_pool),
+        args.users)
+    if args.url:
+        make_client = lambda: HTTPClient(args.url)
+    else:
+        make_client = lambda: TestClient(app)
+
+    curve = []
+    print >>sys.stderr, '%11s %10s %7s %8s %8s %8s' % ('concurrency',
+        'req/sec', 'errors', 'p50 ms', 'p90 ms', 'p99 ms')
+    for concurrency in args.concurrency:
+        result = measure(population, make_client, mix, concurrency,
+            args.seconds, args.seed)
+        curve.append(result)
+        print >>sys.stderr, '%11d %10.1f %7d %8.1f %8.1f %8.1f' % (
+            concurrency, result['requests_per_sec'], result['errors'],
+            result['p50_ms'], result['p90_ms'], result['p99_ms'])
+
+    report = {
+        'target': args.url or 'test client',
+        'seconds': args.seconds,
+        'mix': dict(mix),
+        'curve': curve
+    }
+    if args.output:
+        open(args.output, 'w').write(json.dumps(report, indent=2,
+            sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Seeds the app's database with a synthetic population, to size Redis and
+workers against.
+
+    python -m benchmarks.populate [--users 20000] [--follows 20]
+        [--updates 5] [--threads 2000] [--recipients 8] [--messages 6]
+        [--events 500] [--attendees 40] [--comments 10] [--seed 1] [--flush]
+
+Users are ``user0`` to ``userN``, all with the password ``benchmark``.
+Follower counts follow a power law: low numbered users are followed by
+most others, as a few accounts are on any real network. Updates, thread
+recipients, messages and event attendees and comments are drawn from
+heavy tailed distributions around the given means.
+
+Everything is written through ``wire.models``, so the data is exactly what
+the app would have made. The database is the one the app is configured
+with (``WIRE_SETTINGS`` is honoured), and must be empty unless ``--flush``
+is given.
+"""
+import argparse
+import bisect
+import random
+import sys
+from timeit import default_timer
+
+import redis
+
+from wire import create_app
+from wire.models import Update, Contacts, Event, \
+    ContactExistsError, ContactInvalidError
+from wire.utils import Hasher
+from benchmarks.suite import make_user, make_thread
+
+# Exponents of the power laws: how steeply follows concentrate on the most
+# popular users, and how heavy the tails of per-user counts are.
+POPULARITY = 1.1
+TAIL = 1.5
+
+
+class Population:
+    def __init__(self, r, args):
+        self.r = r
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.users = []
+        weights = [1.0 / (rank + 1) ** POPULARITY
+            for rank in range(args.users)]
+        self.cumulative = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+
+    def count(self, mean, limit):
+        """A heavy tailed count with roughly the given mean."""
+        if mean <= 0:
+            return 0
+        scale = mean * (TAIL - 1) / TAIL
+        return min(int(self.random.paretovariate(TAIL) * scale), limit)
+
+    def popular_user(self):
+        """A user, more likely the lower their number."""
+        point = self.random.random() * self.cumulative[-1]
+        return self.users[bisect.bisect(self.cumulative, point)]
+
+    def some_users(self, count, exclude=None):
+        """Up to ``count`` different users, favouring popular ones until
+        they run out."""
+        count = min(count, len(self.users) - 1)
+        chosen = set()
+        attempts = 0
+        while len(chosen) < count:
+            attempts += 1
+            if attempts < count * 10:
+                user = self.popular_user()
+            else:
+                user = self.random.choice(self.users)
+            if user is not exclude:
+                chosen.add(user)
+        return list(chosen)
+
+    def progress(self, what, done, total, started):
+        if done == total or done % 1000 == 0:
+            print >>sys.stderr, '\r%s: %d/%d (%.0fs)' % (what, done, total,
+                default_timer() - started),
+            if done == total:
+                print >>sys.stderr
+
+    def make_users(self):
+        started = default_timer()
+        for i in range(self.args.users):
+            self.users.append(make_user(self.r, 'user%d' % i))
+            self.progress('users', i + 1, self.args.users, started)
+
+    def make_follows(self):
+        started = default_timer()
+        for i, user in enumerate(self.users):
+            contacts = Contacts(redis=self.r, user=user)
+            follows = self.count(self.args.follows, len(self.users) - 1)
+            for contact in self.some_users(follows, exclude=user):
+                try:
+                    contacts.add(contact.username)
+                except (ContactExistsError, ContactInvalidError):
+                    pass
+            self.progress('follows', i + 1, len(self.users), started)
+
+    def make_updates(self):
+        started = default_timer()
+        keys = []
+        for i, user in enumerate(self.users):
+            for j in range(self.count(self.args.updates, 1000)):
+                text = 'Update %d from %s' % (j, user.username)
+                respond = ''
+                if keys and self.random.random() < 0.2:
+                    respond = self.random.choice(keys)
+                if self.random.random() < 0.1:
+                    text += ' @%s' % self.popular_user().username
+                if self.random.random() < 0.2:
+                    text += ' #tag%d' % self.random.randint(0, 50)
+                u = Update(text=text, redis=self.r, user=user,
+                    respond=respond)
+                u.save()
+                keys.append(str(u.key))
+            self.progress('updates', i + 1, len(self.users), started)
+
+    def make_threads(self):
+        started = default_timer()
+        for i in range(self.args.threads):
+            sender = self.popular_user()
+            recipients = self.some_users(
+                max(1, self.count(self.args.recipients, 200)),
+                exclude=sender)
+            make_thread(self.r, sender,
+                [user.username for user in recipients],
+                messages=max(1, self.count(self.args.messages, 500)))
+            self.progress('threads', i + 1, self.args.threads, started)
+
+    def make_events(self):
+        started = default_timer()
+        for i in range(self.args.events):
+            e = Event(redis=self.r, user=self.popular_user())
+            e.update({
+                'name': 'Event %d' % i,
+                'date': '2012-%02d-%02d' % (self.random.randint(1, 12),
+                    self.random.randint(1, 28)),
+                'time': '%02d:00' % self.random.randint(8, 22),
+                'location': 'Somewhere',
+                'meeting_place': '',
+                'description': 'A synthetic event.'
+            })
+            e.save()
+            attendees = self.count(self.args.attendees, len(self.users))
+            for user in self.some_users(attendees):
+                if self.random.random() < 0.7:
+                    user.set_attending(e.key)
+                else:
+                    user.set_maybe(e.key)
+            comments = []
+            for j in range(self.count(self.args.comments, 500)):
+                respond = ''
+                if comments and self.random.random() < 0.5:
+                    respond = self.random.choice(comments)
+                u = Update(text='Comment %d' % j, redis=self.r,
+                    user=self.popular_user(), respond=respond, event=e.key,
+                    conversation=e.conversation)
+                u.save()
+                comments.append(str(u.key))
+            self.progress('events', i + 1, self.args.events, started)
+
+    def make(self):
+        self.make_users()
+        self.make_follows()
+        self.make_updates()
+        self.make_threads()
+        self.make_events()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--follows', type=float, default=20,
+        help='mean users followed')
+    parser.add_argument('--updates', type=float, default=5,
+        help='mean updates per user')
+    parser.add_argument('--threads', type=int, default=2000)
+    parser.add_argument('--recipients', type=float, default=8,
+        help='mean recipients per thread')
+    parser.add_argument('--messages', type=float, default=6,
+        help='mean messages per thread')
+    parser.add_argument('--events', type=int, default=500)
+    parser.add_argument('--attendees', type=float, default=40,
+        help='mean attendees per event')
+    parser.add_argument('--comments', type=float, default=10,
+        help='mean comments per event')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--flush', action='store_true',
+        help='empty the database first')
+    args = parser.parse_args()
+
+    app = create_app()
+    r = redis.Redis(connection_pool=app.redis_pool)
+    if args.flush:
+        r.flushdb()
+    elif r.dbsize():
+        parser.error('the database is not empty; pass --flush to empty it')
+
+    # Passwords are hashed cheaply here; each is strengthened to the
+    # configured strength on its first login, as old hashes are.
+    Hasher.strength = 1
+    Hasher.processes = 0
+    Update.async_fanout = False
+    started = default_timer()
+    Population(r, args).make()
+    print >>sys.stderr, 'Populated in %.0fs, using %s of memory.' % (
+        default_timer() - started, r.info()['used_memory_human'])
+
+
+if __name__ == '__main__':
+    main()
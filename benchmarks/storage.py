@@ -0,0 +1,166 @@
+"""Compares entities stored as JSON strings and as hashes.
+
+    python -m benchmarks.storage [--count 10000] [--reads 5000]
+        [--ziplist-values 64 256] [--port 6379 --db 15]
+
+For each kind of entity, ``count`` typical ones are written in each
+format, and the memory they take and how fast one field and the whole
+entity can be read back are reported. Hashes are tried with each
+``hash-max-ziplist-value``: entities with a longer field than it lose the
+compact encoding.
+
+A redis-server is started on a free port unless ``--port`` is given; that
+server's ``--db`` is flushed, so don't point it at anything you need.
+"""
+import argparse
+import json
+import random
+from timeit import default_timer
+
+import redis
+
+from wire import storage
+from benchmarks.suite import RedisServer
+
+WORDS = ('the quick brown fox jumps over a lazy dog while we wait for '
+    'everyone to arrive at the station tonight').split()
+
+
+def text(words):
+    return ' '.join(random.choice(WORDS) for i in range(words))
+
+
+SAMPLES = {
+    'user': lambda i: {
+        'username': 'user%d' % i,
+        'password': 'p$15$%s$%s' % ('a' * 32, 'b' * 64),
+        'avatar': 'user%d.png' % i
+    },
+    'update': lambda i: {
+        'username': 'user%d' % i,
+        'text': text(15),
+        'mentions': ['user%d' % (i + 1)],
+        'hashes': ['tag'],
+        'respond': None,
+        'datetime': '2012-06-01 12:00:00.000000',
+        'conversation': i,
+        'event': None
+    },
+    'message': lambda i: {
+        'sender': 'user%d' % i,
+        'date': '2012-06-01 12:00:00.000000',
+        'content': text(25),
+        'thread': i
+    },
+    'event': lambda i: {
+        'name': 'Event %d' % i,
+        'date': '2012-06-01',
+        'time': '18:00',
+        'location': 'Somewhere',
+        'meeting_place': '',
+        'description': text(10),
+        'image': 'default.png',
+        'creator': 'user%d' % i,
+        'conversation': i
+    },
+    'thread': lambda i: {
+        'subject': text(4),
+        'encryption': 'plain'
+    },
+}
+# The field each kind is most often read for on its own.
+FIELD = {
+    'user': 'username',
+    'update': 'text',
+    'message': 'sender',
+    'event': 'name',
+    'thread': 'subject',
+}
+
+
+def write(r, kind, count, hashes):
+    r.flushdb()
+    before = r.info('memory')['used_memory']
+    pipe = r.pipeline(transaction=False)
+    for i in range(count):
+        data = SAMPLES[kind](i)
+        if hashes:
+            pipe.hmset(storage.key(kind, i), storage.encode(kind, data))
+        else:
+            pipe.set(storage.key(kind, i), json.dumps(data))
+        if i % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+    return (r.info('memory')['used_memory'] - before) / float(count)
+
+
+def reads_per_sec(r, count, reads, read):
+    ids = [random.randrange(count) for i in range(reads)]
+    started = default_timer()
+    for id in ids:
+        read(id)
+    return reads / (default_timer() - started)
+
+
+def bench(r, kind, count, reads, ziplist_value=None):
+    hashes = ziplist_value is not None
+    if hashes:
+        r.config_set('hash-max-ziplist-value', ziplist_value)
+    memory = write(r, kind, count, hashes)
+    field = FIELD[kind]
+    if hashes:
+        encoding = r.object('encoding', storage.key(kind, 0))
+        one = lambda id: storage.load(r, kind, id, [field])[field]
+        whole = lambda id: storage.load(r, kind, id)
+    else:
+        encoding = 'json'
+        one = lambda id: json.loads(r.get(storage.key(kind, id)))[field]
+        whole = lambda id: json.loads(r.get(storage.key(kind, id)))
+    return {
+        'kind': kind,
+        'format': hashes and 'hash/%d' % ziplist_value or 'json',
+        'encoding': encoding,
+        'bytes_per_entity': memory,
+        'field_reads_per_sec': reads_per_sec(r, count, reads, one),
+        'whole_reads_per_sec': reads_per_sec(r, count, reads, whole)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--reads', type=int, default=5000)
+    parser.add_argument('--ziplist-values', type=int, nargs='+',
+        default=[64, 256])
+    parser.add_argument('--port', type=int,
+        help='use the redis-server already on this port')
+    parser.add_argument('--db', type=int, default=15)
+    args = parser.parse_args()
+
+    server = None
+    port = args.port
+    if not port:
+        server = RedisServer()
+        port = server.start()
+    try:
+        r = redis.Redis(port=port, db=args.db)
+        ziplist_value = r.config_get('hash-max-ziplist-value')
+        print '%-8s %-9s %-10s %10s %12s %12s' % ('kind', 'format',
+            'encoding', 'bytes', 'field/sec', 'whole/sec')
+        for kind in sorted(SAMPLES):
+            for value in [None] + args.ziplist_values:
+                result = bench(r, kind, args.count, args.reads, value)
+                print '%-8s %-9s %-10s %10.0f %12.0f %12.0f' % (kind,
+                    result['format'], result['encoding'],
+                    result['bytes_per_entity'], result['field_reads_per_sec'],
+                    result['whole_reads_per_sec'])
+        r.config_set('hash-max-ziplist-value',
+            ziplist_value['hash-max-ziplist-value'])
+        r.flushdb()
+    finally:
+        if server:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
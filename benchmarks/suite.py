@@ -0,0 +1,307 @@
+"""Benchmarks the model layer against a throwaway redis-server.
+
+    python -m benchmarks.suite [--sizes 10 100 1000] [--iterations 50]
+        [--only inbox_load thread_load] [--output results.json]
+        [--baseline old.json] [--tolerance 0.1] [--port 6379 --db 15]
+
+Every benchmark is run once per data size, on a database flushed and
+populated for it. Results are printed as JSON: operations per second, p50
+and p99 latency in milliseconds and Redis commands per operation. With
+``--baseline`` they are compared against an earlier run's, and the exit
+status is 1 if anything got slower by more than the tolerance, or sends
+more commands.
+
+A redis-server is started on a free port unless ``--port`` is given; that
+server's ``--db`` is flushed, so don't point it at anything you need.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from timeit import default_timer
+
+import redis
+
+from wire import settings
+from wire.metrics import InstrumentedRedis
+from wire.models import User, Update, Contacts, Inbox, Thread, Message, \
+    Event
+from wire.utils import Auth, Hasher
+
+PASSWORD = 'benchmark'
+
+
+class RedisServer:
+    """A redis-server on a free port, with nothing saved to disk."""
+    def start(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.dir = tempfile.mkdtemp()
+        self.process = subprocess.Popen(['redis-server',
+            '--port', str(self.port), '--bind', '127.0.0.1',
+            '--save', '', '--appendonly', 'no', '--dir', self.dir],
+            stdout=open(os.devnull, 'w'))
+        r = redis.Redis(port=self.port)
+        for i in range(100):
+            try:
+                r.ping()
+                return self.port
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError("redis-server didn't start.")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.dir)
+
+
+def make_user(r, username):
+    u = User(redis=r)
+    u.update({
+        'username': username,
+        'password': PASSWORD,
+        'password_confirm': PASSWORD
+    }, new=True)
+    u.save()
+    return u
+
+
+def make_thread(r, sender, recipients, messages=1):
+    t = Thread(redis=r, user=sender)
+    t.subject = 'Benchmark thread'
+    t.encryption = 'plain'
+    t.parse_recipients(', '.join(recipients))
+    t.save()
+    for i in range(messages):
+        m = Message(redis=r, user=sender)
+        m.update({'content': 'Message %d of the benchmark thread.' % i})
+        t.add_message(m)
+        m.send()
+    return t
+
+
+def bench_update_save(r, size):
+    author = make_user(r, 'author')
+    for i in range(size):
+        Contacts(redis=r, user=make_user(r, 'follower%d' % i)).add('author')
+
+    def op():
+        Update(text='Posting to %d followers #benchmark' % size, redis=r,
+            user=author).save()
+    return op
+
+
+def bench_timeline_get_updates(r, size):
+    author = make_user(r, 'author')
+    reader = make_user(r, 'reader')
+    Contacts(redis=r, user=reader).add('author')
+    for i in range(size):
+        Update(text='Update %d' % i, redis=r, user=author).save()
+    return lambda: reader.timeline.get_updates()
+
+
+def bench_timeline_rebuild(r, size):
+    reader = make_user(r, 'reader')
+    contacts = Contacts(redis=r, user=reader)
+    for i in range(size):
+        author = make_user(r, 'author%d' % i)
+        contacts.add(author.username)
+        for j in range(3):
+            Update(text='Update %d' % j, redis=r, user=author).save()
+    return lambda: reader.timeline.rebuild()
+
+
+def _inbox(r, size):
+    reader = make_user(r, 'reader')
+    sender = make_user(r, 'sender')
+    for i in range(size):
+        make_thread(r, sender, ['reader'], messages=2)
+    return reader
+
+
+def bench_inbox_load(r, size):
+    reader = _inbox(r, size)
+    return lambda: Inbox(user=reader, redis=r).load_messages(limit=30)
+
+
+def bench_inbox_unread_count(r, size):
+    reader = _inbox(r, size)
+    return lambda: Inbox(user=reader, redis=r).unread_count()
+
+
+def bench_thread_load(r, size):
+    reader = make_user(r, 'reader')
+    sender = make_user(r, 'sender')
+    t = make_thread(r, sender, ['reader'], messages=size)
+    return lambda: Thread(redis=r, user=reader).load(t.key, limit=30)
+
+
+def bench_event_list(r, size):
+    creator = make_user(r, 'creator')
+    for i in range(size):
+        e = Event(redis=r, user=creator)
+        e.update({
+            'name': 'Event %d' % i,
+            'date': '2012-01-01',
+            'time': '18:00',
+            'location': 'Somewhere',
+            'meeting_place': '',
+            'description': 'A benchmark event.'
+        })
+        e.save()
+    return lambda: Event(redis=r, user=creator).list(limit=20)
+
+
+def bench_contacts_search(r, size):
+    for i in range(size):
+        make_user(r, 'user%d' % i)
+    contacts = Contacts(redis=r, user=make_user(r, 'searcher'))
+    return lambda: contacts.search(u'ser1')
+
+
+def bench_auth_attempt(r, size):
+    for i in range(size):
+        make_user(r, 'user%d' % i)
+    return lambda: Auth(r).attempt('user0', PASSWORD)
+
+
+BENCHMARKS = [
+    ('update_save', bench_update_save),
+    ('timeline_get_updates', bench_timeline_get_updates),
+    ('timeline_rebuild', bench_timeline_rebuild),
+    ('inbox_load', bench_inbox_load),
+    ('inbox_unread_count', bench_inbox_unread_count),
+    ('thread_load', bench_thread_load),
+    ('event_list', bench_event_list),
+    ('contacts_search', bench_contacts_search),
+    ('auth_attempt', bench_auth_attempt),
+]
+
+
+def percentile(ordered, fraction):
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def run(r, name, setup, size, iterations, warmup=3):
+    r.flushdb()
+    # Users are made with cheap hashes; auth_attempt's warm up rehashes
+    # its user at the configured strength.
+    Hasher.strength = 1
+    op = setup(r, size)
+    Hasher.strength = settings.HASHER_STRENGTH
+    for i in range(warmup):
+        op()
+
+    latencies = []
+    r.reset()
+    started = default_timer()
+    for i in range(iterations):
+        op_started = default_timer()
+        op()
+        latencies.append(default_timer() - op_started)
+    elapsed = default_timer() - started
+    latencies.sort()
+    return {
+        'name': name,
+        'size': size,
+        'iterations': iterations,
+        'ops_per_sec': iterations / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'commands_per_op': r.commands / float(iterations)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints each result against the baseline's, returning how many got
+    slower by more than ``tolerance`` or send more commands."""
+    before = dict(((b['name'], b['size']), b) for b in baseline['results'])
+    regressions = 0
+    print >>sys.stderr, '%-22s %6s %12s %8s %10s %8s %10s' % ('benchmark',
+        'size', 'ops/sec', 'change', 'p99 ms', 'change', 'cmds/op')
+    for result in results:
+        b = before.get((result['name'], result['size']))
+        if not b:
+            continue
+        ops = result['ops_per_sec'] / b['ops_per_sec'] - 1
+        p99 = result['p99_ms'] / b['p99_ms'] - 1
+        flag = ''
+        if ops < -tolerance or \
+                result['commands_per_op'] > b['commands_per_op']:
+            regressions += 1
+            flag = ' REGRESSION'
+        print >>sys.stderr, '%-22s %6d %12.1f %+7.0f%% %10.2f %+7.0f%% ' \
+            '%4.1f>%4.1f%s' % (result['name'], result['size'],
+            result['ops_per_sec'], ops * 100, result['p99_ms'], p99 * 100,
+            b['commands_per_op'], result['commands_per_op'], flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[10, 100, 1000])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--only', nargs='+',
+        choices=[name for name, setup in BENCHMARKS])
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--port', type=int,
+        help='use the redis-server already on this port')
+    parser.add_argument('--db', type=int, default=15)
+    args = parser.parse_args()
+
+    server = None
+    port = args.port
+    if not port:
+        server = RedisServer()
+        port = server.start()
+    try:
+        r = InstrumentedRedis(port=port, db=args.db)
+        Hasher.algorithm = settings.HASHER_ALGORITHM
+        Hasher.processes = 0
+        Update.async_fanout = False
+        Update.pull_threshold = None
+        results = []
+        for name, setup in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            for size in args.sizes:
+                results.append(run(r, name, setup, size, args.iterations))
+                print >>sys.stderr, '%s(%d): %.1f ops/sec' % (name, size,
+                    results[-1]['ops_per_sec'])
+        report = {
+            'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'redis': r.info()['redis_version'],
+            'results': results
+        }
+        r.flushdb()
+    finally:
+        if server:
+            server.stop()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        open(args.output, 'w').write(output)
+    print output
+
+    if args.baseline:
+        if compare(results, json.load(open(args.baseline)), args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
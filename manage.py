@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+import argparse
+
+import redis
+
+from wire import create_app
+
+
+def fanout_worker(r, args):
+    from wire.fanout import FanoutWorker
+    worker = FanoutWorker(r, batch_size=args.batch_size,
+        max_attempts=args.max_attempts)
+    worker.run(once=args.once)
+
+
+def index_usernames(r, args):
+    from wire.models import index_username
+    count = 0
+    for username in r.lrange('list:usernames', 0, -1):
+        index_username(r, username.decode('UTF-8'))
+        count += 1
+    print 'Indexed %d usernames.' % count
+
+
+def migrate_attendance(r, args):
+    from wire.models import migrate_attendance
+    print 'Converted %d attendance lists to sets.' % migrate_attendance(r)
+
+
+def index_threads(r, args):
+    from wire.models import index_threads
+    print 'Indexed %d threads.' % index_threads(r)
+
+
+def reconcile_unreads(r, args):
+    from wire.models import reconcile_unreads
+    print 'Repaired %d unread totals.' % reconcile_unreads(r)
+
+
+def migrate_storage(r, args):
+    from wire.storage import migrate
+    print 'Converted %d entities to hashes.' % migrate(r,
+        batch_size=args.batch_size)
+
+
+def archive_lists(r, args):
+    from wire.archive import trim_all
+    print 'Archived the oldest updates of %d lists.' % trim_all(r)
+
+
+def slow_requests(r, args):
+    from wire import profiling
+    directory = args.dir or profiling.SlowRequests.directory
+    for line in profiling.summarize(directory, top=args.top):
+        print line
+
+
+def resize_images(r, args):
+    from wire import images
+    images.ImageProcessor.processes = 0
+    images.recover()
+    counts = images.stats()
+    print 'Resized %d staged images, %d failed.' % (counts['processed'],
+        counts['failed'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='wire management commands')
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('fanout-worker',
+        help='push queued updates onto follower timelines')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.add_argument('--max-attempts', type=int, default=5)
+    command.add_argument('--once', action='store_true',
+        help='exit when the queue is empty')
+    command.set_defaults(func=fanout_worker)
+
+    command = commands.add_parser('index-usernames',
+        help='backfill the contact search indexes')
+    command.set_defaults(func=index_usernames)
+
+    command = commands.add_parser('migrate-attendance',
+        help='convert event attendance lists to sets')
+    command.set_defaults(func=migrate_attendance)
+
+    command = commands.add_parser('index-threads',
+        help='backfill inbox indexes and thread summaries')
+    command.set_defaults(func=index_threads)
+
+    command = commands.add_parser('reconcile-unreads',
+        help='rebuild unread totals from per-thread counts')
+    command.set_defaults(func=reconcile_unreads)
+
+    command = commands.add_parser('migrate-storage',
+        help='convert entities stored as JSON strings to hashes')
+    command.add_argument('--batch-size', type=int, default=500)
+    command.set_defaults(func=migrate_storage)
+
+    command = commands.add_parser('archive-lists',
+        help='cap timeline, updates and mentions lists from before caps')
+    command.set_defaults(func=archive_lists)
+
+    command = commands.add_parser('slow-requests',
+        help='summarize the slowest endpoints and where they spend time')
+    command.add_argument('--dir',
+        help='where samples were saved (default: SLOW_REQUEST_DIR)')
+    command.add_argument('--top', type=int, default=10)
+    command.set_defaults(func=slow_requests)
+
+    command = commands.add_parser('resize-images',
+        help='resize uploads left staged by workers that exited')
+    command.set_defaults(func=resize_images)
+
+    args = parser.parse_args()
+    app = create_app()
+    args.func(redis.Redis(connection_pool=app.redis_pool), args)
+
+
+if __name__ == '__main__':
+    main()
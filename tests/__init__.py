@@ -0,0 +1,30 @@
+"""Tests, run with ``python -m unittest discover tests``.
+
+Tests that need Redis run against a redis-server of their own, started on a
+free port, and are skipped where redis-server isn't installed.
+"""
+import unittest
+
+import redis
+
+from benchmarks.suite import RedisServer
+
+
+class RedisTestCase(unittest.TestCase):
+    """Gives each test a flushed database on a throwaway redis-server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = RedisServer()
+        try:
+            port = cls.server.start()
+        except OSError:
+            raise unittest.SkipTest('redis-server is not installed.')
+        cls.redis = redis.Redis(port=port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.redis.flushdb()
@@ -0,0 +1,135 @@
+"""Checks that uploads show placeholders until resized, under a new version
+once they are, that failures keep them and that the counts at
+/status/images add up.
+
+``convert`` is replaced by a copy that records what it was asked for, so
+these run without ImageMagick.
+"""
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from wire import images
+from wire.images import ImageProcessor
+
+SIZES = [('', 80), ('@2x', 160)]
+
+
+class TestImages(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.dir, 'avatar')
+        os.makedirs(self.dest)
+        self.placeholder = os.path.join(self.dir, 'default.png')
+        open(self.placeholder, 'w').write('placeholder')
+
+        self.settings = (ImageProcessor.processes, ImageProcessor.staging)
+        ImageProcessor.processes = 0
+        ImageProcessor.staging = os.path.join(self.dir, 'staging')
+        self.resize = images.resize
+        images.resize = self.fake_resize
+        self.error = None
+        self.shown = []
+        self.versions = []
+        self.counts = images.stats()
+
+    def tearDown(self):
+        ImageProcessor.processes, ImageProcessor.staging = self.settings
+        images.resize = self.resize
+        shutil.rmtree(self.dir)
+
+    def fake_resize(self, source, target, x, y=False):
+        directory, filename = os.path.split(target)
+        final = os.path.join(directory, filename[1:])
+        self.shown.append(open(final).read())
+        self.versions.append(images.version(final))
+        if self.error:
+            raise self.error
+        open(target, 'w').write('%s at %d' % (open(source).read(), x))
+
+    def upload(self, name='upload.jpg'):
+        path = os.path.join(self.dest, name)
+        open(path, 'w').write('image')
+        return images.stage(path, self.dest, SIZES, self.placeholder)
+
+    def read(self, name):
+        return open(os.path.join(self.dest, name)).read()
+
+    def changed(self):
+        counts = images.stats()
+        return dict((k, counts[k] - self.counts[k]) for k in counts)
+
+    def assertCleanedUp(self):
+        self.assertEqual(os.listdir(ImageProcessor.staging), [])
+        self.assertEqual(sorted(os.listdir(self.dest)),
+            ['upload.jpg', 'upload@2x.jpg'])
+
+    def test_resize(self):
+        self.assertEqual(self.upload(), 'upload.jpg')
+        self.assertEqual(self.shown, ['placeholder', 'placeholder'])
+        self.assertEqual(self.read('upload.jpg'), 'image at 80')
+        self.assertEqual(self.read('upload@2x.jpg'), 'image at 160')
+        self.assertCleanedUp()
+        self.assertEqual(self.changed(),
+            {'queued': 0, 'processed': 1, 'failed': 0})
+
+    def test_version(self):
+        self.upload()
+        version = images.version(os.path.join(self.dest, 'upload.jpg'))
+        self.assertTrue(version)
+        self.assertNotEqual(version, self.versions[0])
+        self.assertEqual(images.version(os.path.join(self.dest, 'none.jpg')),
+            '')
+
+    def test_resize_in_pool(self):
+        ImageProcessor.processes = 2
+        for i in range(4):
+            self.upload('upload%d.jpg' % i)
+        for i in range(500):
+            if self.changed()['processed'] == 4:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.changed(),
+            {'queued': 0, 'processed': 4, 'failed': 0})
+        self.assertEqual(self.read('upload3@2x.jpg'), 'image at 160')
+
+    def test_convert_fails(self):
+        self.error = subprocess.CalledProcessError(1, 'convert')
+        self.upload()
+        self.assertEqual(self.read('upload.jpg'), 'placeholder')
+        self.assertEqual(self.read('upload@2x.jpg'), 'placeholder')
+        self.assertCleanedUp()
+        self.assertEqual(self.changed(),
+            {'queued': 0, 'processed': 0, 'failed': 1})
+
+    def test_unexpected_error(self):
+        self.error = IOError('No space left on device')
+        self.upload()
+        self.assertEqual(self.read('upload.jpg'), 'placeholder')
+        self.assertEqual(self.changed(),
+            {'queued': 0, 'processed': 0, 'failed': 1})
+
+    def test_recover(self):
+        # Jobs left by a process that has exited, and by one still running.
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        os.makedirs(ImageProcessor.staging)
+        for name, pid in [('upload.jpg', exited.pid),
+                ('running.jpg', os.getppid())]:
+            staged = os.path.join(ImageProcessor.staging, name)
+            open(staged, 'w').write('image')
+            targets = [(os.path.join(self.dest, name), 80)]
+            json.dump(targets, open('%s.%d.job' % (staged, pid), 'w'))
+            shutil.copyfile(self.placeholder, targets[0][0])
+
+        self.assertEqual(images.recover(), 1)
+        self.assertEqual(self.read('upload.jpg'), 'image at 80')
+        self.assertEqual(self.read('running.jpg'), 'placeholder')
+        self.assertEqual(sorted(os.listdir(ImageProcessor.staging)),
+            ['running.jpg', 'running.jpg.%d.job' % os.getppid()])
+        self.assertEqual(self.changed(),
+            {'queued': 0, 'processed': 1, 'failed': 0})
@@ -0,0 +1,112 @@
+"""Checks the model code that keeps inboxes in step with their threads, and
+that pages timelines."""
+from wire import storage
+from wire.models import Contacts, Inbox, Message, Thread, Update, User, \
+    _activity, reconcile_unreads
+from wire.utils import Hasher
+
+from benchmarks.suite import make_user
+from tests import RedisTestCase
+
+
+class TestUnreads(RedisTestCase):
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        r = self.redis
+        r.rpush('list:users', '1', '2')
+        r.rpush('user:1:threads', '5', '6')
+        # Counts from before they were kept in a hash, for a thread that
+        # has since had a reply and one that hasn't.
+        r.set('user:1:thread:5:unreads', 3)
+        r.set('user:1:thread:6:unreads', 2)
+
+        # A reply arrives before the user next opens a page.
+        t = Thread(redis=r, user=User(redis=r, key='2'))
+        t.key = '5'
+        t.recipients = ['1', '2']
+        t._incr_unreads()
+        self.inbox = Inbox(redis=r, user=User(redis=r, key='1'))
+
+    def test_old_counts_on_first_view(self):
+        r = self.redis
+        self.assertEqual(self.inbox.unread_count(), 6)
+        self.assertEqual(r.hgetall('user:1:unreads'), {'5': '4', '6': '2'})
+        self.assertEqual(r.keys('user:1:thread:*'), [])
+        self.assertEqual(reconcile_unreads(r), 0)
+        self.assertEqual(self.inbox.unread_count(), 6)
+
+    def test_old_counts_on_reconcile(self):
+        r = self.redis
+        self.assertEqual(reconcile_unreads(r), 1)
+        self.assertEqual(r.hgetall('user:1:unreads'), {'5': '4', '6': '2'})
+        self.assertEqual(self.inbox.unread_count(), 6)
+
+
+class TestDeleteMessage(RedisTestCase):
+    def test_inbox_moves_back(self):
+        r = self.redis
+        dates = ['2026-01-01 10:00:00', '2026-01-02 10:00:00']
+        for key, date in zip(['11', '12'], dates):
+            storage.save(r, 'message', key,
+                {'sender': 'alice', 'content': 'hi', 'date': date})
+            r.rpush('thread:5:messages', key)
+        r.rpush('thread:5:recipients', '1', '2')
+        for user_key in ['1', '2']:
+            r.zadd('user:%s:inbox' % user_key, '5', _activity(dates[1]))
+
+        t = Thread(redis=r, user=User(redis=r, key='1'))
+        t.key = '5'
+        m = Message(redis=r)
+        m.key = '12'
+        t.delete_message(m)
+        self.assertEqual(r.hget('thread:5:summary', 'last_date'), dates[0])
+        for user_key in ['1', '2']:
+            self.assertEqual(r.zscore('user:%s:inbox' % user_key, '5'),
+                _activity(dates[0]))
+
+
+class TestTimelinePages(RedisTestCase):
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        self.async_fanout = Update.async_fanout
+        self.pull_threshold = Update.pull_threshold
+        self.strength = Hasher.strength
+        Update.async_fanout = False
+        Hasher.strength = 1
+        r = self.redis
+        self.alice = make_user(r, 'alice')
+        self.bob = make_user(r, 'bob')
+        Contacts(redis=r, user=self.bob).add('alice')
+        Contacts(redis=r, user=make_user(r, 'carol')).add('alice')
+
+    def tearDown(self):
+        Update.async_fanout = self.async_fanout
+        Update.pull_threshold = self.pull_threshold
+        Hasher.strength = self.strength
+
+    def post(self, count):
+        for i in range(count):
+            Update(text='Update %d' % i, redis=self.redis,
+                user=self.alice).save()
+
+    def pages(self, timeline, limit):
+        """The number of updates on each page of ``timeline``."""
+        pages = []
+        cursor = {}
+        while cursor is not None:
+            updates, cursor = timeline.get_page(limit=limit, **cursor)
+            pages.append(len(updates))
+        return pages
+
+    def test_last_page_full(self):
+        self.post(4)
+        self.assertEqual(self.pages(self.bob.timeline, 2), [2, 2])
+        self.assertEqual(self.pages(self.bob.timeline, 4), [4])
+        self.assertEqual(self.pages(self.bob.timeline, 3), [3, 1])
+        self.assertEqual(self.pages(self.alice.posted, 2), [2, 2])
+
+    def test_last_page_full_pulled(self):
+        Update.pull_threshold = 1
+        self.post(4)
+        self.assertEqual(self.pages(self.bob.timeline, 2), [2, 2])
+        self.assertEqual(self.pages(self.bob.timeline, 3), [3, 1])
@@ -0,0 +1,254 @@
+"""Checks that each Lua script leaves Redis as the separate commands it
+replaced did.
+
+Each test sets up some state, applies a change with the commands the model
+used to send, snapshots every key, then restores the state and applies the
+same change through the model, which now runs the script.
+"""
+from wire import fanout
+from wire import models
+from wire import storage
+from wire.models import Contacts, ContactExistsError, ContactInvalidError, \
+    Thread, Update, User
+from wire.utils import Hasher
+
+from benchmarks.suite import make_user
+from tests import RedisTestCase
+
+
+def snapshot(r):
+    state = {}
+    for key in r.keys('*'):
+        type = r.type(key)
+        if type == 'string':
+            value = r.get(key)
+        elif type == 'list':
+            value = r.lrange(key, 0, -1)
+        elif type == 'set':
+            value = r.smembers(key)
+        elif type == 'zset':
+            value = r.zrange(key, 0, -1, withscores=True)
+        elif type == 'hash':
+            value = r.hgetall(key)
+        state[key] = (type, value)
+    return state
+
+
+def restore(r, state):
+    r.flushdb()
+    for key, (type, value) in state.items():
+        if type == 'string':
+            r.set(key, value)
+        elif type == 'list':
+            r.rpush(key, *value)
+        elif type == 'set':
+            r.sadd(key, *value)
+        elif type == 'zset':
+            r.zadd(key, **dict(value))
+        elif type == 'hash':
+            r.hmset(key, value)
+
+
+def old_rsvp(r, user_key, event_id, state):
+    attendees = 'event:%s:attendees' % event_id
+    maybes = 'event:%s:maybes' % event_id
+    attending = 'user:%s:attending' % user_key
+    maybe = 'user:%s:maybe' % user_key
+    if state == 'attending':
+        r.sadd(attendees, user_key)
+        r.srem(maybes, user_key)
+        r.sadd(attending, event_id)
+        r.srem(maybe, event_id)
+    elif state == 'maybe':
+        r.sadd(maybes, user_key)
+        r.srem(attendees, user_key)
+        r.sadd(maybe, event_id)
+        r.srem(attending, event_id)
+    else:
+        r.srem(attendees, user_key)
+        r.srem(maybes, user_key)
+        r.srem(attending, event_id)
+        r.srem(maybe, event_id)
+
+
+def old_add_contact(r, user_key, username):
+    contacts = 'user:%s:contacts' % user_key
+    if username in r.lrange(contacts, 0, -1):
+        raise ContactExistsError()
+    if not r.exists('username:%s' % username):
+        raise ContactInvalidError()
+    r.lpush('user:%s:followers' % r.get('username:%s' % username), user_key)
+    r.lpush(contacts, username)
+    r.sort(contacts, alpha=True, store=contacts)
+
+
+def old_sync_recipients(r, thread_key, unreads, score, recipients):
+    current = r.lrange('thread:%s:recipients' % thread_key, 0, -1)
+    for recipient in recipients:
+        if recipient not in current:
+            current.append(recipient)
+            r.rpush('thread:%s:recipients' % thread_key, recipient)
+            r.lpush('user:%s:threads' % recipient, thread_key)
+            r.zadd('user:%s:inbox' % recipient, **{thread_key: score})
+            r.hincrby('user:%s:unreads' % recipient, thread_key, unreads)
+            r.incr('user:%s:unreads:total' % recipient, unreads)
+
+
+def old_delete_update(r, update):
+    if update.event:
+        r.lrem('event:%s:comments' % update.event, update.key, 0)
+    else:
+        r.zrem(fanout.pulled_key(update.user.key), update.key)
+        update._del_followers()
+        r.lrem('user:%s:timeline' % update.user.key, update.key, 0)
+        r.lrem('user:%s:updates' % update.user.key, update.key, 0)
+    for mentionee in update.mentions:
+        key = r.get('username:%s' % mentionee)
+        r.lrem('user:%s:timeline' % key, update.key, 0)
+        r.lrem('user:%s:mentions' % key, update.key, 0)
+    r.lrem('conversation:%s' % update.conversation, update.key, 0)
+    r.delete('fragment:update:%s' % update.key)
+    r.delete('update:%s' % update.key)
+
+
+class ScriptTestCase(RedisTestCase):
+    def compare(self, old, new):
+        """Asserts that ``old`` and ``new`` leave the same keys, and raise
+        the same exception if any."""
+        r = self.redis
+        before = snapshot(r)
+        results = []
+        for change in [old, new]:
+            restore(r, before)
+            try:
+                change()
+                raised = None
+            except Exception as e:
+                raised = type(e)
+            results.append((raised, snapshot(r)))
+        self.assertEqual(results[1][0], results[0][0])
+        self.assertEqual(results[1][1], results[0][1])
+        return results[1][0]
+
+
+class TestRsvp(ScriptTestCase):
+    def test_rsvp(self):
+        r = self.redis
+        user = User(redis=r, key='1')
+        setters = {
+            'attending': user.set_attending,
+            'maybe': user.set_maybe,
+            'unattending': user.set_unattending
+        }
+        for current in setters:
+            for state in setters:
+                r.flushdb()
+                r.sadd('event:7:attendees', '2')
+                r.sadd('user:1:attending', '8')
+                if current != 'unattending':
+                    old_rsvp(r, '1', '7', current)
+                self.compare(lambda: old_rsvp(r, '1', '7', state),
+                    lambda: setters[state]('7'))
+
+
+class TestAddContact(ScriptTestCase):
+    def setUp(self):
+        ScriptTestCase.setUp(self)
+        r = self.redis
+        for key, username in [('1', 'alice'), ('2', 'bob'), ('3', 'carol')]:
+            r.set('username:%s' % username, key)
+        r.rpush('user:1:contacts', 'bob')
+        r.rpush('user:2:followers', '1')
+        self.contacts = Contacts(redis=r, user=User(redis=r, key='1'))
+
+    def test_already_a_contact(self):
+        raised = self.compare(lambda: old_add_contact(self.redis, '1', 'bob'),
+            lambda: self.contacts.add('bob'))
+        self.assertEqual(raised, ContactExistsError)
+
+    def test_unknown_user(self):
+        raised = self.compare(
+            lambda: old_add_contact(self.redis, '1', 'nobody'),
+            lambda: self.contacts.add('nobody'))
+        self.assertEqual(raised, ContactInvalidError)
+
+    def test_new_contact(self):
+        raised = self.compare(
+            lambda: old_add_contact(self.redis, '1', 'carol'),
+            lambda: self.contacts.add('carol'))
+        self.assertEqual(raised, None)
+        self.assertEqual(self.contacts.contacts, ['bob', 'carol'])
+
+
+class TestSyncRecipients(ScriptTestCase):
+    def setUp(self):
+        ScriptTestCase.setUp(self)
+        self.activity = models._activity
+        models._activity = lambda date: 1000.0
+
+    def tearDown(self):
+        models._activity = self.activity
+
+    def test_sync_recipients(self):
+        r = self.redis
+        for key, username in [('1', 'alice'), ('2', 'bob'), ('3', 'carol')]:
+            storage.save(r, 'user', key, {'username': username})
+        r.rpush('thread:5:recipients', '1', '2')
+        r.lpush('user:2:threads', '4')
+        r.hset('user:3:unreads', '4', 2)
+        r.set('user:3:unreads:total', 2)
+
+        t = Thread(redis=r, user=User(redis=r, key='1'))
+        t.key = '5'
+        t.message_count = 3
+        t.recipients = ['1', '2', '3', '3']
+        self.compare(
+            lambda: old_sync_recipients(r, '5', 3, 1000.0, ['1', '2', '3']),
+            t._sync_recipients)
+        self.assertEqual(t.recipient_usernames, ['alice', 'bob', 'carol'])
+
+
+class TestDeleteUpdate(ScriptTestCase):
+    def setUp(self):
+        ScriptTestCase.setUp(self)
+        self.async_fanout = Update.async_fanout
+        self.pull_threshold = Update.pull_threshold
+        self.strength = Hasher.strength
+        Update.async_fanout = False
+        Hasher.strength = 1
+        r = self.redis
+        self.alice = make_user(r, 'alice')
+        for username in ['bob', 'carol']:
+            Contacts(redis=r, user=make_user(r, username)).add('alice')
+
+    def tearDown(self):
+        Update.async_fanout = self.async_fanout
+        Update.pull_threshold = self.pull_threshold
+        Hasher.strength = self.strength
+
+    def delete(self, key):
+        old = Update(redis=self.redis, key=key)
+        new = Update(redis=self.redis, key=key)
+        self.compare(lambda: old_delete_update(self.redis, old), new.delete)
+
+    def test_delete_update(self):
+        u = Update(text='Hello @bob @nobody #tag', redis=self.redis,
+            user=self.alice)
+        u.save()
+        Update(text='A reply', redis=self.redis, user=self.alice,
+            respond=str(u.key)).save()
+        self.delete(u.key)
+
+    def test_delete_pulled_update(self):
+        Update.pull_threshold = 1
+        for text in ['Pushed before', 'Pulled @carol']:
+            u = Update(text=text, redis=self.redis, user=self.alice)
+            u.save()
+        self.delete(u.key)
+
+    def test_delete_event_comment(self):
+        storage.save(self.redis, 'event', '9', {'name': 'Meeting'})
+        u = Update(text='See you there @carol', redis=self.redis,
+            user=self.alice, event='9')
+        u.save()
+        self.delete(u.key)
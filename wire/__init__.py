@@ -2,12 +2,19 @@ import sys
 import logging
 from logging import Formatter, FileHandler
 
+import redis
 from flask import Flask, render_template
 
 from flaskext.markdown import Markdown
 from flaskext.uploads import configure_uploads, UploadSet, IMAGES
 
+from wire import archive
+from wire import cache
+from wire import images
+from wire import profiling
+from wire import scripts
 from wire.settings import *
+from wire.utils import create_redis_pool, Hasher
 
 uploaded_avatars = UploadSet('avatars', IMAGES)
 uploaded_images = UploadSet('images', IMAGES)
@@ -23,6 +30,41 @@ def create_app(debug=False):
     app.config.from_object('wire.settings')
     app.config.from_envvar('WIRE_SETTINGS', silent=True)
     app.config['DEBUG'] = debug
+    app.redis_pool = create_redis_pool(app.config)
+
+    if app.config['HASHER_ALGORITHM'] not in Hasher.algorithms:
+        raise ValueError("Unknown HASHER_ALGORITHM %s."
+            % app.config['HASHER_ALGORITHM'])
+    Hasher.algorithm = app.config['HASHER_ALGORITHM']
+    Hasher.strength = app.config['HASHER_STRENGTH']
+    Hasher.processes = app.config['HASHER_PROCESSES']
+
+    archive.Archive.cap = app.config['TIMELINE_CAP']
+    archive.Archive.batch = app.config['TIMELINE_TRIM_BATCH']
+    if app.config['ARCHIVE_REDIS_HOST']:
+        archive.Archive.pool = create_redis_pool(dict(app.config,
+            REDIS_HOST=app.config['ARCHIVE_REDIS_HOST'],
+            REDIS_PORT=app.config['ARCHIVE_REDIS_PORT'],
+            REDIS_DB=app.config['ARCHIVE_REDIS_DB']))
+
+    try:
+        scripts.load(redis.Redis(connection_pool=app.redis_pool))
+    except redis.ConnectionError:
+        app.logger.warning("Couldn't preload Lua scripts, Redis is down.")
+
+    images.ImageProcessor.processes = app.config['IMAGE_PROCESSES']
+    images.ImageProcessor.quality = app.config['IMAGE_QUALITY']
+    images.ImageProcessor.staging = app.config['UPLOADS_STAGING_DEST']
+    cache.users = cache.LRUCache(size=app.config['USER_CACHE_SIZE'],
+        ttl=app.config['USER_CACHE_TTL'])
+    profiling.SlowRequests.threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    profiling.SlowRequests.interval = app.config['SLOW_REQUEST_INTERVAL']
+    profiling.SlowRequests.directory = app.config['SLOW_REQUEST_DIR']
+    profiling.SlowRequests.keep = app.config['SLOW_REQUEST_KEEP']
+
+    from wire.models import Update
+    Update.async_fanout = app.config['FANOUT_ASYNC']
+    Update.pull_threshold = app.config['FANOUT_PULL_THRESHOLD']
     configure_uploads(app, uploaded_avatars)
     configure_uploads(app, uploaded_images)
     Markdown(app)
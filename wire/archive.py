@@ -0,0 +1,130 @@
+"""Caps on timeline, updates and mentions lists, and the archive of what
+falls off their ends.
+
+After pushing onto one of these lists, callers pass its new length to
+``trim``. Once a list is ``batch`` entries over ``cap``, its oldest entries
+are moved, newest first, into the list's archive: a string of update ids
+packed four bytes each, oldest first, kept on the archive Redis server so
+that the main one only holds the lists' hot ends.
+
+Read together, a list and its archive are one sequence, newest first,
+that trimming doesn't change; ``Timeline.get_page`` pages on into the
+archive with ``get_range`` once it runs out of list. Deleted updates are
+left in archives, and skipped when loaded.
+"""
+import struct
+
+import redis
+
+from wire import scripts
+
+# The lists of each user that are capped.
+LISTS = ['timeline', 'updates', 'mentions']
+
+
+class Archive:
+    # Set from config by create_app. A cap of None leaves lists to grow.
+    cap = 1000
+    batch = 100
+    # Connection pool of the archive server; None keeps archives alongside
+    # the lists they came from.
+    pool = None
+
+
+def client(redis_client):
+    if Archive.pool is None:
+        return redis_client
+    return redis.Redis(connection_pool=Archive.pool)
+
+
+def key(list_key):
+    return 'archive:%s' % list_key
+
+
+def _pack(ids):
+    ids = [int(id) for id in ids]
+    return struct.pack('>%dI' % len(ids), *ids)
+
+
+def _unpack(blob):
+    # GETRANGE past the start of a string still returns its first byte.
+    blob = blob[:len(blob) - len(blob) % 4]
+    return [str(id) for id in struct.unpack('>%dI' % (len(blob) // 4), blob)]
+
+
+def trim(redis, list_key, length):
+    """Archives the oldest entries of ``list_key``, now ``length`` long, if
+    it has grown far enough past the cap."""
+    if Archive.cap is None or length <= Archive.cap + Archive.batch:
+        return
+    _move(redis, list_key)
+
+
+def _move(redis, list_key):
+    trimmed = scripts.call(redis, 'trim_list', keys=[list_key],
+        args=[Archive.cap])
+    if trimmed:
+        client(redis).append(key(list_key), _pack(reversed(trimmed)))
+    return len(trimmed)
+
+
+def trim_all(redis):
+    """Archives the oldest entries of every user's lists down to the cap,
+    for lists from before they were capped. Returns how many lists were
+    trimmed."""
+    if Archive.cap is None:
+        return 0
+    count = 0
+    for user_key in redis.lrange('list:users', 0, -1):
+        for name in LISTS:
+            list_key = 'user:%s:%s' % (user_key, name)
+            if redis.llen(list_key) > Archive.cap and \
+                    _move(redis, list_key):
+                count += 1
+    return count
+
+
+def split(ids, newest=None):
+    """Splits ``ids``, newest first, into those to keep in the list and
+    those to archive, for callers rewriting a whole list: those past the
+    cap, and those no newer than ``newest``, the newest id already archived,
+    so that the list stays newer than its archive."""
+    if Archive.cap is None:
+        return ids, []
+    keep = ids[:Archive.cap]
+    if newest is not None:
+        keep = [id for id in keep if int(id) > int(newest)]
+    return keep, ids[len(keep):]
+
+
+def get_range(redis, list_key, start, count):
+    """Returns up to ``count`` archived ids, newest first, skipping the
+    ``start`` newest."""
+    blob = client(redis).getrange(key(list_key), -(start + count) * 4,
+        -start * 4 - 1)
+    return list(reversed(_unpack(blob)))
+
+
+def get_all(redis, list_key):
+    """Every archived id, newest first."""
+    return list(reversed(_unpack(client(redis).get(key(list_key)) or '')))
+
+
+def merge(redis, list_key, ids):
+    _rewrite(redis, list_key, lambda archived: archived | set(ids))
+
+
+def remove(redis, list_key, ids):
+    _rewrite(redis, list_key, lambda archived: archived - set(ids))
+
+
+def _rewrite(redis, list_key, change):
+    k = key(list_key)
+
+    def rewrite(pipe):
+        ids = change(set(_unpack(pipe.get(k) or '')))
+        pipe.multi()
+        pipe.delete(k)
+        if ids:
+            pipe.set(k, _pack(sorted(ids, key=int)))
+    client(redis).transaction(rewrite, k)
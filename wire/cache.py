@@ -0,0 +1,144 @@
+"""In-process cache of user profiles, shared by every request in a worker.
+
+Profiles (the ``user:N`` blobs) and ``username:X`` mappings are kept in an
+LRU of bounded size, each entry for at most ``ttl`` seconds. ``User.save``
+calls ``invalidate``, which drops the entries here and publishes them on
+``CHANNEL``; every other worker has a thread subscribed to it that drops
+them too. If that subscription breaks, the worker empties its cache, and
+the TTL bounds how stale an entry can get if a message is lost anyway.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+CHANNEL = 'cache:users'
+
+log = logging.getLogger('wire.cache')
+
+
+class LRUCache:
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._items[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.size < 1:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, time.time() + self.ttl)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._items),
+            'max_size': self.size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations
+        }
+
+
+# Replaced with one sized from config by create_app.
+users = LRUCache(size=0)
+
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def get_many(redis_pool, keys):
+    """Returns the cached values of ``keys``, None where there are none."""
+    if users.size < 1:
+        return [None] * len(keys)
+    listen(redis_pool)
+    return [users.get(key) for key in keys]
+
+
+def set_many(items):
+    for key, value in items:
+        if value is not None:
+            users.set(key, value)
+
+
+def invalidate(redis, user_key, username):
+    """Drops a user's profile and username mapping here and, through
+    ``CHANNEL``, in every other worker."""
+    keys = ['user:%s' % user_key, 'username:%s' % username]
+    for key in keys:
+        users.delete(key)
+    redis.publish(CHANNEL, json.dumps(keys))
+
+
+def listen(redis_pool):
+    """Starts this process's invalidation thread, once per process: a
+    worker forked from a preloaded app doesn't inherit the parent's."""
+    global _listener_pid
+    if users.size < 1 or _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        users.clear()
+        thread = threading.Thread(target=_listen, args=(redis_pool,))
+        thread.daemon = True
+        thread.start()
+
+
+def _listen(redis_pool):
+    kwargs = dict(redis_pool.connection_kwargs)
+    # Invalidations can be a long time coming; don't time out waiting.
+    kwargs['socket_timeout'] = None
+    while True:
+        try:
+            pubsub = redis.StrictRedis(**kwargs).pubsub(
+                ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            for message in pubsub.listen():
+                for key in json.loads(message['data']):
+                    users.delete(key)
+        except redis.RedisError:
+            log.exception("Lost user cache invalidations, emptying it.")
+        users.clear()
+        time.sleep(1)
@@ -0,0 +1,209 @@
+"""Fan-out of new updates onto their author's followers' timelines.
+
+Posting an update only queues a job; a ``FanoutWorker`` (run with
+``manage.py fanout-worker``) takes jobs off the queue and pushes the update
+onto every follower's timeline in pipelined batches.
+
+Updates from users with more followers than a threshold are not pushed at
+all: they are indexed by id and pulled into their followers' timelines as
+those are read, so posting costs the same however many followers there are.
+"""
+import json
+import logging
+import time
+
+from redis.exceptions import ConnectionError, RedisError
+
+from wire import archive
+from wire import storage
+
+QUEUE = 'queue:fanout'
+PROCESSING = 'queue:fanout:processing'
+FAILED = 'queue:fanout:failed'
+STATS = 'stats:fanout'
+# Users with more followers than the threshold have their updates pulled
+# into timelines when read, rather than pushed to every follower.
+PULLED_USERS = '_hash:pulled_users'
+PULLED_SINCE = '_hash:pulled_since'
+# How long we remember which followers a job already reached.
+DONE_TTL = 60 * 60 * 24
+
+log = logging.getLogger('wire.fanout')
+
+
+def make_job(update_key, user_key, skip=(), threshold=None):
+    return {
+        'update': str(update_key),
+        'user': str(user_key),
+        'skip': [str(key) for key in skip],
+        'threshold': threshold,
+        'attempts': 0
+    }
+
+
+def enqueue(redis, update_key, user_key, skip=(), threshold=None):
+    """Queues ``update_key`` for pushing to the followers of ``user_key``,
+    leaving out the user keys in ``skip``."""
+    redis.lpush(QUEUE, json.dumps(
+        make_job(update_key, user_key, skip, threshold)))
+
+
+def fan_out(redis, job, batch_size=500):
+    """Pushes a job's update onto its followers' timelines, returning how
+    many timelines it was pushed to.
+
+    Followers reached are recorded in the same transaction as the push, so a
+    job that fails half way and is retried never pushes twice.
+    """
+    r = redis
+    if not r.exists('update:%s' % job['update']):
+        return 0
+
+    if r.hexists(PULLED_SINCE, job['user']):
+        r.zadd(pulled_key(job['user']),
+            **{str(job['update']): int(job['update'])})
+        return 0
+
+    if job.get('threshold') and \
+            r.llen('user:%s:followers' % job['user']) > job['threshold']:
+        mark_pulled(r, job['user'], job['update'])
+        return 0
+
+    done_key = 'fanout:%s:done' % job['update']
+    followers = set(r.lrange('user:%s:followers' % job['user'], 0, -1))
+    followers -= set(job['skip'])
+    followers -= r.smembers(done_key)
+    followers.discard(job['user'])
+    followers = list(followers)
+
+    for i in range(0, len(followers), batch_size):
+        batch = followers[i:i + batch_size]
+        pipe = r.pipeline()
+        for follower in batch:
+            pipe.lpush('user:%s:timeline' % follower, job['update'])
+        pipe.sadd(done_key, *batch)
+        pipe.expire(done_key, DONE_TTL)
+        lengths = pipe.execute()
+        for follower, length in zip(batch, lengths):
+            archive.trim(r, 'user:%s:timeline' % follower, length)
+    return len(followers)
+
+
+def pulled_key(user_key):
+    return 'user:%s:updates:pulled' % user_key
+
+
+def mark_pulled(redis, user_key, since):
+    """Stops pushing ``user_key``'s updates from update ``since`` onwards.
+    Their updates are indexed by id instead, for timelines to pull from."""
+    r = redis
+    username = storage.load(r, 'user', user_key, ['username'])['username']
+    keys = r.lrange('user:%s:updates' % user_key, 0, -1)
+    pipe = r.pipeline()
+    keys.append(str(since))
+    for i in range(0, len(keys), 1000):
+        pipe.zadd(pulled_key(user_key),
+            **dict((key, int(key)) for key in keys[i:i + 1000]))
+    pipe.hset(PULLED_USERS, username, user_key)
+    pipe.hset(PULLED_SINCE, user_key, since)
+    pipe.execute()
+
+
+def pull(redis, usernames, before=None, limit=30):
+    """Returns the newest ``limit`` update ids older than ``before`` posted
+    by whichever of ``usernames`` are pulled rather than pushed."""
+    r = redis
+    if not usernames:
+        return []
+    user_keys = [key for key in r.hmget(PULLED_USERS, usernames) if key]
+    if not user_keys:
+        return []
+
+    top = '+inf'
+    if before:
+        top = '(%s' % before
+    pipe = r.pipeline(transaction=False)
+    for user_key in user_keys:
+        pipe.zrevrangebyscore(pulled_key(user_key), top, '-inf',
+            start=0, num=limit)
+    keys = set()
+    for result in pipe.execute():
+        keys.update(result)
+    return sorted(keys, key=int, reverse=True)[:limit]
+
+
+def stats(redis):
+    pipe = redis.pipeline(transaction=False)
+    pipe.llen(QUEUE)
+    pipe.llen(PROCESSING)
+    pipe.llen(FAILED)
+    pipe.hgetall(STATS)
+    queued, processing, failed, counters = pipe.execute()
+    result = {
+        'queued': queued,
+        'processing': processing,
+        'failed': failed
+    }
+    for name in ['processed', 'pushed', 'retried', 'gave_up']:
+        result[name] = int(counters.get(name, 0))
+    return result
+
+
+class FanoutWorker:
+    def __init__(self, redis, batch_size=500, max_attempts=5, timeout=5):
+        self.redis = redis
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+    def run(self, once=False):
+        """Processes jobs until interrupted, or until the queue is empty
+        when ``once`` is set."""
+        self.recover()
+        while True:
+            try:
+                raw = self.redis.brpoplpush(QUEUE, PROCESSING, self.timeout)
+            except ConnectionError:
+                log.exception("Lost connection to Redis, retrying.")
+                time.sleep(self.timeout)
+                continue
+            if raw is None:
+                if once:
+                    return
+                continue
+            self.process(raw)
+
+    def recover(self):
+        """Requeues jobs left in processing by a worker that died. Jobs are
+        idempotent, so taking over one still in flight is harmless."""
+        while self.redis.rpoplpush(PROCESSING, QUEUE):
+            pass
+
+    def process(self, raw):
+        r = self.redis
+        job = json.loads(raw)
+        try:
+            pushed = fan_out(r, job, self.batch_size)
+        except RedisError:
+            log.exception("Fan-out of update %s failed." % job['update'])
+            self._retry(raw, job)
+            return
+
+        pipe = r.pipeline()
+        pipe.lrem(PROCESSING, raw, 1)
+        pipe.hincrby(STATS, 'processed', 1)
+        pipe.hincrby(STATS, 'pushed', pushed)
+        pipe.execute()
+
+    def _retry(self, raw, job):
+        job['attempts'] += 1
+        pipe = self.redis.pipeline()
+        pipe.lrem(PROCESSING, raw, 1)
+        if job['attempts'] < self.max_attempts:
+            pipe.lpush(QUEUE, json.dumps(job))
+            pipe.hincrby(STATS, 'retried', 1)
+        else:
+            pipe.lpush(FAILED, json.dumps(job))
+            pipe.hincrby(STATS, 'gave_up', 1)
+        pipe.execute()
+        time.sleep(min(2 ** job['attempts'], 30))
@@ -1,7 +1,11 @@
-from flask import Blueprint, g, session, config, current_app
+import os
+from timeit import default_timer
 
-from wire.models import User, Inbox, UserNotFoundError
+from flask import Blueprint, g, session, config, current_app, request
+
+from wire.models import User, UserMap, Inbox, UserNotFoundError
 from wire.utils import Auth
+from wire import images, metrics, profiling
 
 import redis
 
@@ -11,20 +15,19 @@ frontend = Blueprint('frontend', __name__,
 
 @frontend.before_request
 def before_request():
+    g.started = default_timer()
+    profiling.start(request.endpoint, request.method, request.path)
     g.logged_in = False
-    g.r = redis.Redis(
-        host=current_app.config['REDIS_HOST'],
-        port=current_app.config['REDIS_PORT'],
-        db=current_app.config['REDIS_DB']
-    )
+    g.r = metrics.InstrumentedRedis(connection_pool=current_app.redis_pool)
 
     g.auth = Auth(g.r)
+    g.users = UserMap(g.r)
     g.user = User(redis=g.r)
     g.GMAPS_KEY = current_app.config['GMAPS_KEY']
     try:
         if session['logged_in']:
             g.logged_in = True
-            g.user.load(session['logged_in'])
+            g.user = g.users.get(session['logged_in'])
             g.inbox = Inbox(user=g.user, redis=g.r)
             g.unread_count = g.inbox.unread_count()
     except KeyError:
@@ -38,6 +41,39 @@ def before_request():
 def after_request(response):
     """Closes the database again at the end of the request."""
     session.pop('user', g.auth.user)
+    metrics.record(request.endpoint, g.r, default_timer() - g.started)
+    if current_app.debug and internal():
+        response.headers['X-Redis'] = metrics.debug_header(g.r)
+    g.status = response.status_code
     return response
 
+
+@frontend.app_url_defaults
+def image_version(endpoint, values):
+    """Adds the version of an uploaded image to links to it, which are
+    otherwise the same before and after it has been resized."""
+    if endpoint != 'static' or 'filename' not in values:
+        return
+    config = current_app.config
+    path = os.path.join(current_app.static_folder, values['filename'])
+    directory = os.path.dirname(os.path.abspath(path))
+    if directory in [os.path.abspath(config['UPLOADED_AVATARS_DEST']),
+            os.path.abspath(config['UPLOADED_IMAGES_DEST'])]:
+        values['v'] = images.version(path)
+
+
+def internal():
+    """Whether this request may see the worker's metrics and status."""
+    config = current_app.config
+    return config['STATUS_ENDPOINTS'] and \
+        'X-Forwarded-For' not in request.headers and \
+        request.remote_addr in config['STATUS_ADDRESSES']
+
+
+@frontend.teardown_request
+def teardown_request(exception):
+    """Saves the request's stack samples if it was slow, even if it
+    failed."""
+    profiling.finish(default_timer() - g.started, getattr(g, 'status', 500))
+
 import views
@@ -1,18 +1,20 @@
+import hashlib
 import json
+import math
+import os
 import redis
 import uuid
-import subprocess
 
 from flask import Blueprint, request, session, g, redirect, url_for, abort, \
-     render_template, flash, current_app
+     render_template, flash, current_app, Markup
 
 from flaskext.uploads import (UploadSet, configure_uploads, IMAGES,
                               UploadNotAllowed)
 
-from wire.frontend import frontend
+from wire.frontend import frontend, internal
 
 from wire.models import User, UserValidationError, \
-    Update, UpdateError, UserNotFoundError
+    Update, UpdateError, UserNotFoundError, load_updates
 from wire.models import Message, \
     MessageValidationError
 from wire.models import Inbox
@@ -24,6 +26,10 @@ from wire.models import Event, EventValidationError,\
     EventNotFoundError, EventCommentError
 
 from wire.utils import Auth, AuthError
+from wire import cache
+from wire import fanout
+from wire import images
+from wire import metrics
 
 from wire import uploaded_images, uploaded_avatars
 
@@ -34,30 +40,45 @@ def timeline():
         g.user.username
     except AttributeError:
         abort(401)
-    timeline = g.user.timeline
-    return render_template('timeline.html',
-        timeline=timeline.updates,
+    return render_timeline(g.user.timeline, 'frontend.timeline',
+        'frontend.async_timeline',
         title='Timeline')
 
 
+@frontend.route('/async/timeline')
+def async_timeline():
+    try:
+        g.user.username
+    except AttributeError:
+        abort(401)
+    return async_updates(g.user.timeline, 'frontend.async_timeline')
+
+
 @frontend.route('/mentions')
 def mentions():
     try:
         g.user.username
     except AttributeError:
         abort(401)
-    timeline = g.user.mentions
     g.user.reset_mentions()
-    return render_template('timeline.html',
-        timeline=timeline.updates,
+    return render_timeline(g.user.mentions, 'frontend.mentions',
+        'frontend.async_mentions',
         title='Mentions')
 
 
+@frontend.route('/async/mentions')
+def async_mentions():
+    try:
+        g.user.username
+    except AttributeError:
+        abort(401)
+    return async_updates(g.user.mentions, 'frontend.async_mentions')
+
+
 @frontend.route('/user/<string:username>')
 def user_updates(username):
-    u = User(redis=g.r)
     try:
-        u.load_by_username(username)
+        u = g.users.get_by_username(username)
     except UserNotFoundError:
         abort(404)
 
@@ -66,23 +87,112 @@ def user_updates(username):
     else:
         state = 'nocontact'
 
-    return render_template('timeline.html',
-        timeline=u.posted.updates,
+    return render_timeline(u.posted, 'frontend.user_updates',
+        'frontend.async_user_updates',
+        url_args={'username': username},
         user=u,
         state=state,
         title='%s' % username,
         disable_input=True)
 
 
+@frontend.route('/async/user/<string:username>')
+def async_user_updates(username):
+    try:
+        u = g.users.get_by_username(username)
+    except UserNotFoundError:
+        abort(404)
+    return async_updates(u.posted, 'frontend.async_user_updates',
+        url_args={'username': username})
+
+
+def timeline_page(timeline):
+    return timeline.get_page(
+        before=request.args.get('before', None, type=int),
+        offset=request.args.get('offset', 0, type=int),
+        limit=current_app.config['TIMELINE_PAGE_SIZE'])
+
+
+def cursor_url(endpoint, cursor, url_args={}):
+    if not cursor:
+        return None
+    args = dict(url_args)
+    args.update(cursor)
+    return url_for(endpoint, **args)
+
+
+def render_timeline(timeline, endpoint, async_endpoint, url_args={},
+    **context):
+    updates, cursor = timeline_page(timeline)
+    return render_template('timeline.html',
+        fragments=render_updates(updates),
+        older_url=cursor_url(endpoint, cursor, url_args),
+        more_url=cursor_url(async_endpoint, cursor, url_args),
+        **context)
+
+
+def async_updates(timeline, endpoint, url_args={}):
+    updates, cursor = timeline_page(timeline)
+    return json.dumps({
+        'html': render_template('updates.html',
+            fragments=render_updates(updates)),
+        'more': cursor_url(endpoint, cursor, url_args)
+    })
+
+
+def render_updates(updates):
+    """Renders each update with update.html, through a cache of the HTML
+    in Redis. Updates never change once posted, so a page of them is
+    mostly one pipeline of cache reads.
+
+    Each update keeps its fragments in a hash, one per variant of what it
+    shows; an author changing their avatar or username, or their avatar
+    being resized, makes a new variant, and Update.delete drops the hash.
+    """
+    ttl = current_app.config['FRAGMENT_CACHE_TTL']
+    if not ttl:
+        return [Markup(render_template('update.html', update=update))
+            for update in updates]
+
+    variants = [fragment_variant(update) for update in updates]
+    pipe = g.r.pipeline(transaction=False)
+    for update, variant in zip(updates, variants):
+        pipe.hget('fragment:update:%s' % update.key, variant)
+    cached = pipe.execute()
+
+    fragments = []
+    pipe = g.r.pipeline(transaction=False)
+    for update, variant, html in zip(updates, variants, cached):
+        if html is None:
+            html = render_template('update.html', update=update)
+            pipe.hset('fragment:update:%s' % update.key, variant, html)
+            pipe.expire('fragment:update:%s' % update.key, ttl)
+        else:
+            html = html.decode('UTF-8')
+        fragments.append(Markup(html))
+    pipe.execute()
+    return fragments
+
+
+def fragment_variant(update):
+    mine = getattr(g.user, 'username', None) == update.user.username
+    return hashlib.sha1(json.dumps([
+        current_app.config['FRAGMENT_VERSION'],
+        mine,
+        update.user.username,
+        update.user.avatar,
+        images.version(os.path.join(
+            current_app.config['UPLOADED_AVATARS_DEST'], update.user.avatar)),
+        update.data.get('event_name')
+    ])).hexdigest()
+
+
 @frontend.route('/conversation/<int:conversation_id>')
 def conversation(conversation_id):
-    updates = []
-    for key in g.r.lrange('conversation:%s' % conversation_id, 0, -1):
-        u = Update(redis=g.r, user=g.user)
-        u.load(key)
-        updates.append(u)
+    updates = load_updates(g.r,
+        g.r.lrange('conversation:%s' % conversation_id, 0, -1))
     return render_template('timeline.html',
-        timeline=updates,
+        fragments=render_updates(updates),
         title='Conversation #%s' % conversation_id,
         disable_input=True,
         disable_userbox=True)
@@ -136,15 +246,20 @@ def developers():
 
 @frontend.route('/inbox')
 def inbox():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['INBOX_PAGE_SIZE']
     i = g.inbox
-    i.load_messages()
+    count = i.load_messages(limit=per_page, start=(page - 1) * per_page)
     if len(i.threads) == 0:
         empty = True
     else:
         empty = False
     return render_template('inbox.html',
         threads=i.threads,
-        empty=empty)
+        empty=empty,
+        count=count,
+        page=page,
+        pages=max(int(math.ceil(count / float(per_page))), 1))
 
 
 @frontend.route('/inbox/mark-all-read')
@@ -153,10 +268,7 @@ def mark_all_read():
         g.user.username
     except AttributeError:
         abort(401)
-    i = g.inbox
-    i.load_messages()
-    for thread in i.threads:
-        thread.reset_unread_count()
+    g.inbox.mark_all_read()
     flash('All messages marked read.', 'success')
     return redirect(url_for('frontend.inbox'))
 
@@ -168,7 +280,7 @@ def view_thread(thread_id):
 
     t = Thread(redis=g.r, user=g.user)
     try:
-        t.load(thread_id)
+        t.load(thread_id, limit=0)
         if request.method == "POST":
             if request.form['action'] == 'reply':
                 m = Message(redis=g.r, key=False, user=g.user)
@@ -176,15 +288,44 @@ def view_thread(thread_id):
                 t.save()
                 t.add_message(m)
                 m.send()
-                t.load(thread_id)
                 flash("Reply has been sent.", 'success')
                 return redirect(url_for('frontend.view_thread', thread_id=t.key))
+        messages, cursor = thread_page(t)
         return render_template('thread.html',
-            messages=t.messages,
+            messages=messages,
             thread=t,
-            subject=t.subject)
+            subject=t.subject,
+            older_url=cursor_url('frontend.view_thread', cursor,
+                {'thread_id': t.key}),
+            more_url=cursor_url('frontend.async_thread', cursor,
+                {'thread_id': t.key}))
+    except ThreadError:
+        abort(404)
+
+
+@frontend.route('/async/thread/<int:thread_id>')
+def async_thread(thread_id):
+    if str(thread_id) not in g.user.get_threads():
+        abort(401)
+
+    t = Thread(redis=g.r, user=g.user)
+    try:
+        t.load(thread_id, limit=0)
     except ThreadError:
         abort(404)
+    messages, cursor = thread_page(t)
+    return json.dumps({
+        'html': render_template('messages.html', messages=messages, thread=t),
+        'more': cursor_url('frontend.async_thread', cursor,
+            {'thread_id': t.key})
+    })
+
+
+def thread_page(thread):
+    return thread.get_messages(
+        before=request.args.get('before', None, type=int),
+        index=request.args.get('index', None, type=int),
+        limit=current_app.config['THREAD_PAGE_SIZE'])
 
 
 @frontend.route('/send/<string:recipient>')
@@ -237,7 +378,7 @@ def send_message(recipient=False):
 def delete_message(message_id, thread_id):
     if request.method == 'POST':
         t = Thread(redis=g.r, user=g.user)
-        t.load(thread_id)
+        t.load(thread_id, limit=0)
         m = Message(redis=g.r, user=g.user, key=message_id)
         m.load()
         if g.r.get('username:%s' % m.sender.username) != g.user.key:
@@ -263,7 +404,7 @@ def mark_thread_read(thread_id):
         abort(401)
 
     t = Thread(redis=g.r, user=g.user)
-    t.load(thread_id)
+    t.load(thread_id, limit=0)
     t.reset_unread_count()
     abort(200)
 
@@ -276,7 +417,7 @@ def unsubscribe_thread(thread_id):
         abort(401)
     if request.method == "POST":
         t = Thread(redis=g.r, user=g.user)
-        t.load(thread_id)
+        t.load(thread_id, limit=0)
         t.unsubscribe()
         flash(u'Unsubscribed from thread.', 'success')
         return redirect(url_for('frontend.inbox'))
@@ -298,7 +439,7 @@ def del_thread(thread_id):
         abort(401)
     if request.method == "POST":
         t = Thread(redis=g.r, user=g.user)
-        t.load(thread_id)
+        t.load(thread_id, limit=0)
         t.delete()
         flash(u'Deleted thread.', 'success')
         return redirect(url_for('frontend.inbox'))
@@ -322,7 +463,7 @@ def add_recipient(thread_id):
     if request.form['confirm'] == '1':
         try:
             t = Thread(redis=g.r, user=g.user)
-            t.load(thread_id)
+            t.load(thread_id, limit=0)
             t.parse_recipients(username)
             t.save()
             flash('Added recipient.', 'success')
@@ -378,7 +519,7 @@ def add_contact(contact, redirect_url=None):
         abort(401)
     try:
         c = Contacts(redis=g.r, user=g.user)
-        c.add(contact)
+        g.user.timeline.merge_user(c.add(contact))
         flash('Added user "%s" to address book.' % contact, 'success')
     except KeyError:
         flash('No user specified.', 'error')
@@ -387,8 +528,6 @@ def add_contact(contact, redirect_url=None):
     except ContactExistsError:
         flash('User "%s" is already in your address book.' % contact, 'error')
 
-    t = g.user.timeline
-    t.rebuild()
     if not redirect_url:
         redirect_url = url_for('frontend.contacts')
     return redirect(redirect_url)
@@ -407,7 +546,8 @@ def async_contact_search(part):
     except AttributeError:
         abort(401)
     c = Contacts(redis=g.r, user=g.user)
-    return json.dumps(c.search(part))
+    return json.dumps(c.search(part,
+        limit=current_app.config['CONTACT_SEARCH_LIMIT']))
 
 
 @frontend.route('/delete-contact/<string:contact>')
@@ -417,9 +557,10 @@ def del_contact(contact, redirect_url=None):
     except AttributeError:
         abort(401)
     c = Contacts(redis=g.r, user=g.user)
+    contact_key = c.contact_key(contact)
     c.delete(contact)
-    t = g.user.timeline
-    t.rebuild()
+    if contact_key:
+        g.user.timeline.remove_user(contact_key)
     flash('Deleted contact "%s".' % contact, 'success')
     if not redirect_url:
         redirect_url = url_for('frontend.contacts')
@@ -428,11 +569,15 @@ def del_contact(contact, redirect_url=None):
 
 @frontend.route('/events')
 def list_events():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['EVENTS_PAGE_SIZE']
     e = Event(redis=g.r, user=g.user)
-    events, count = e.list()
+    events, count = e.list(limit=per_page, start=(page - 1) * per_page)
     return render_template('events.html',
         events=events,
-        count=count
+        count=count,
+        page=page,
+        pages=max(int(math.ceil(count / float(per_page))), 1)
     )
 
 
@@ -442,7 +587,7 @@ def view_event(event_id):
     e.load(event_id)
     return render_template('event.html',
         event=e,
-        state=g.user.get_event_state(event_id)
+        state=e.state
     )
 
 
@@ -504,9 +649,9 @@ def save_event(event_id=False, new=False):
 def upload_event_image(image):
     ext = image.filename.split(".")[-1]
     filename = uploaded_images.save(image, name="%s.%s" % (unique_id(), ext))
-    path = "%s/%s" % (current_app.config['UPLOADED_IMAGES_DEST'], filename)
-    resize_image(path, 160)
-    return filename
+    dest = current_app.config['UPLOADED_IMAGES_DEST']
+    return images.stage("%s/%s" % (dest, filename), dest,
+        images.EVENT_IMAGE_SIZES, "%s/default.png" % dest)
 
 
 @frontend.route('/event/<int:event_id>/delete', methods=['GET', 'POST'])
@@ -663,34 +808,51 @@ def edit_user(new=False):
 def upload_avatar(avatar):
     ext = avatar.filename.split(".")[-1]
     filename = uploaded_avatars.save(avatar, name="%s.%s" % (unique_id(), ext))
-    path = "%s/%s" % (current_app.config['UPLOADED_AVATARS_DEST'], filename)
-    resize_image(path, 80)
-    return filename
-
-
-def resize_image(path, x, y=False):
-    if not y:
-        y = x
-    args = [
-        'convert',
-        path,
-        '-resize',
-        '%sx%s^' % (x, y),
-        '-gravity',
-        'center',
-        '-extent',
-        '%sx%s' % (x, y),
-        '-quality',
-        '100',
-        path
-    ]
-    return subprocess.check_output(args)
+    dest = current_app.config['UPLOADED_AVATARS_DEST']
+    return images.stage("%s/%s" % (dest, filename), dest,
+        images.AVATAR_SIZES, "%s/default.png" % dest)
 
 
 def unique_id():
     return hex(uuid.uuid4().time)[2:-1]
 
 
+@frontend.route('/metrics')
+def metrics_endpoint():
+    if not internal():
+        abort(404)
+    return current_app.response_class(metrics.render(),
+        mimetype='text/plain; version=0.0.4')
+
+
+@frontend.route('/status/redis-pool')
+def redis_pool_status():
+    if not internal():
+        abort(404)
+    return json.dumps(current_app.redis_pool.stats())
+
+
+@frontend.route('/status/user-cache')
+def user_cache_status():
+    if not internal():
+        abort(404)
+    return json.dumps(cache.users.stats())
+
+
+@frontend.route('/status/images')
+def images_status():
+    if not internal():
+        abort(404)
+    return json.dumps(images.stats())
+
+
+@frontend.route('/status/fanout')
+def fanout_status():
+    if not internal():
+        abort(404)
+    return json.dumps(fanout.stats(g.r))
+
+
 @frontend.route('/login', methods=['POST'])
 def login():
     try:
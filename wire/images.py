@@ -0,0 +1,188 @@
+"""Resizing of uploaded avatars and event images, off the request.
+
+``stage`` moves an upload to a staging directory and copies a placeholder
+into place under each of its final names, so the new image can be linked
+to straight away. A pool of ``processes`` threads, each running one
+ImageMagick ``convert`` at a time, then resizes the original to every size
+and moves the results over the placeholders. Links to an image carry its
+``version``, so that browsers holding the placeholder fetch it again.
+
+Each staged upload has a job file beside it naming its targets and the
+process resizing it. ``recover`` queues again the uploads of processes that
+exited before finishing them, so that they don't keep their placeholders.
+"""
+import errno
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
+
+# Suffix added to the file name, and the width and height, of each size
+# made. The first is the name stored and shown by default.
+AVATAR_SIZES = [('', 80), ('@2x', 160), ('-small', 40)]
+EVENT_IMAGE_SIZES = [('', 160), ('@2x', 320)]
+
+JOB = re.compile(r'^(.+)\.(\d+)\.job$')
+
+log = logging.getLogger('wire.images')
+
+
+class ImageProcessor:
+    # Set from config by create_app.
+    processes = 2
+    quality = 85
+    staging = 'wire/uploads/staging'
+
+
+_pool = None
+_pool_pid = None
+_pool_size = None
+_lock = threading.Lock()
+_counts = {'queued': 0, 'processed': 0, 'failed': 0}
+
+
+def _processor_pool(processes):
+    """The pool images are resized in, one per worker process."""
+    global _pool, _pool_pid, _pool_size
+    if _pool is None or _pool_pid != os.getpid() or _pool_size != processes:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = ThreadPool(processes)
+        _pool_pid = os.getpid()
+        _pool_size = processes
+        recover()
+    return _pool
+
+
+def stage(path, dest, sizes, placeholder):
+    """Queues the uploaded image at ``path`` for resizing into ``dest`` and
+    returns the file name to store for it. Until it has been resized, each
+    of its names shows ``placeholder``."""
+    if not os.path.isdir(ImageProcessor.staging):
+        os.makedirs(ImageProcessor.staging)
+    filename = os.path.basename(path)
+    staged = os.path.join(ImageProcessor.staging, filename)
+    shutil.move(path, staged)
+
+    name, ext = os.path.splitext(filename)
+    targets = []
+    for suffix, size in sizes:
+        target = os.path.join(dest, name + suffix + ext)
+        shutil.copyfile(placeholder, target)
+        targets.append((target, size))
+
+    with open(_job(staged), 'w') as f:
+        json.dump(targets, f)
+    _queue(staged, targets)
+    return filename
+
+
+def _job(staged):
+    return '%s.%d.job' % (staged, os.getpid())
+
+
+def _queue(staged, targets):
+    with _lock:
+        _counts['queued'] += 1
+    if ImageProcessor.processes < 1:
+        process(staged, targets)
+    else:
+        _processor_pool(ImageProcessor.processes).apply_async(process,
+            (staged, targets))
+
+
+def process(staged, targets):
+    """Resizes ``staged`` to each of ``targets``, a list of path and size,
+    and removes it. A target is only replaced once it is complete."""
+    result = 'failed'
+    try:
+        for target, size in targets:
+            directory, filename = os.path.split(target)
+            partial = os.path.join(directory, '.' + filename)
+            resize(staged, partial, size)
+            os.rename(partial, target)
+        result = 'processed'
+    except Exception:
+        log.exception("Couldn't resize %s." % staged)
+    finally:
+        for path in [staged, _job(staged)]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    log.exception("Couldn't remove %s." % path)
+        with _lock:
+            _counts['queued'] -= 1
+            _counts[result] += 1
+
+
+def recover():
+    """Queues again the uploads staged by processes that have exited since,
+    taking over their jobs. Returns how many were queued."""
+    staging = ImageProcessor.staging
+    if not os.path.isdir(staging):
+        return 0
+    count = 0
+    for name in os.listdir(staging):
+        match = JOB.match(name)
+        if not match or _running(int(match.group(2))):
+            continue
+        staged = os.path.join(staging, match.group(1))
+        try:
+            # Only one process can rename the job away from its old owner.
+            os.rename(os.path.join(staging, name), _job(staged))
+            with open(_job(staged)) as f:
+                targets = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        _queue(staged, targets)
+        count += 1
+    return count
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def resize(source, target, x, y=False):
+    """Crops ``source`` to fill ``x`` by ``y`` pixels, writing ``target``."""
+    if not y:
+        y = x
+    args = [
+        'convert',
+        source,
+        '-resize',
+        '%sx%s^' % (x, y),
+        '-gravity',
+        'center',
+        '-extent',
+        '%sx%s' % (x, y),
+        '-strip',
+        '-quality',
+        str(ImageProcessor.quality),
+        target
+    ]
+    return subprocess.check_output(args, stderr=subprocess.STDOUT)
+
+
+def version(path):
+    """A token for the file at ``path`` that changes whenever it is
+    replaced, as a placeholder is by its resized image, or '' if there is
+    no such file."""
+    try:
+        return '%x' % os.stat(path).st_ino
+    except OSError:
+        return ''
+
+
+def stats():
+    with _lock:
+        return dict(_counts)
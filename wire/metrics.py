@@ -0,0 +1,176 @@
+"""Counts what each request asks of Redis, and how long it takes, for
+``/metrics``.
+
+Requests use an ``InstrumentedRedis``, which counts the commands it sends
+(pipelined ones included), the bytes of their arguments and replies and
+the time spent waiting on them. ``record`` adds a request's counts and its
+duration to the process's totals and histograms for its endpoint, which
+``render`` writes out in the Prometheus text format. Totals are per
+process: scrape every worker.
+"""
+import threading
+from timeit import default_timer
+
+import redis
+import redis.client
+
+COUNTERS = [
+    ('wire_requests_total', 'Requests handled.'),
+    ('wire_redis_commands_total', 'Redis commands sent.'),
+    ('wire_redis_bytes_sent_total', 'Bytes of Redis command arguments.'),
+    ('wire_redis_bytes_received_total', 'Bytes of Redis replies.'),
+    ('wire_redis_seconds_total', 'Seconds spent waiting on Redis.'),
+]
+HISTOGRAMS = [
+    ('wire_request_duration_seconds', 'Seconds taken to handle requests.'),
+]
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class InstrumentedRedis(redis.Redis):
+    def __init__(self, *args, **kwargs):
+        redis.Redis.__init__(self, *args, **kwargs)
+        self.reset()
+
+    def reset(self):
+        self.commands = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+
+    def execute_command(self, *args, **options):
+        started = default_timer()
+        try:
+            response = redis.Redis.execute_command(self, *args, **options)
+        finally:
+            self._count(1, args, started)
+        self.bytes_received += _size(response)
+        return response
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self, transaction, shard_hint)
+
+    def _count(self, commands, args, started):
+        self.commands += commands
+        self.bytes_sent += _size(args)
+        self.seconds += default_timer() - started
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def __init__(self, owner, transaction, shard_hint):
+        redis.client.Pipeline.__init__(self, owner.connection_pool,
+            owner.response_callbacks, transaction, shard_hint)
+        self.owner = owner
+
+    def immediate_execute_command(self, *args, **options):
+        started = default_timer()
+        try:
+            response = redis.client.Pipeline.immediate_execute_command(self,
+                *args, **options)
+        finally:
+            self.owner._count(1, args, started)
+        self.owner.bytes_received += _size(response)
+        return response
+
+    def execute(self, raise_on_error=True):
+        stack = [args for args, options in self.command_stack]
+        started = default_timer()
+        try:
+            response = redis.client.Pipeline.execute(self, raise_on_error)
+        finally:
+            self.owner._count(len(stack), stack, started)
+        self.owner.bytes_received += _size(response)
+        return response
+
+
+def _size(value):
+    """Roughly how many bytes ``value`` takes on the wire."""
+    if isinstance(value, (list, tuple, set)):
+        return sum(_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.items())
+    if isinstance(value, unicode):
+        return len(value.encode('UTF-8'))
+    if value is None or isinstance(value, (bool, Exception)):
+        return 0
+    return len(str(value))
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, endpoint, amount=1):
+        with self._lock:
+            key = (name, endpoint)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, endpoint, value):
+        with self._lock:
+            key = (name, endpoint)
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            histogram = self.histograms[key]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = dict((key, (list(buckets), total, count))
+                for key, (buckets, total, count) in self.histograms.items())
+        lines = []
+        for name, help in COUNTERS:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            for (counter, endpoint), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append('%s{endpoint="%s"} %s' % (name, endpoint,
+                        value))
+        for name, help in HISTOGRAMS:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s histogram' % name)
+            for (histogram, endpoint), (buckets, total, count) in \
+                    sorted(histograms.items()):
+                if histogram != name:
+                    continue
+                for bound, value in zip(BUCKETS, buckets):
+                    lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (
+                        name, endpoint, bound, value))
+                lines.append('%s_bucket{endpoint="%s",le="+Inf"} %d' % (
+                    name, endpoint, count))
+                lines.append('%s_sum{endpoint="%s"} %s' % (name, endpoint,
+                    total))
+                lines.append('%s_count{endpoint="%s"} %d' % (name, endpoint,
+                    count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def record(endpoint, r, duration):
+    """Adds a request's Redis counts and duration in seconds to its
+    endpoint's totals."""
+    endpoint = endpoint or 'unknown'
+    registry.inc('wire_requests_total', endpoint)
+    registry.observe('wire_request_duration_seconds', endpoint, duration)
+    registry.inc('wire_redis_commands_total', endpoint, r.commands)
+    registry.inc('wire_redis_bytes_sent_total', endpoint, r.bytes_sent)
+    registry.inc('wire_redis_bytes_received_total', endpoint,
+        r.bytes_received)
+    registry.inc('wire_redis_seconds_total', endpoint, r.seconds)
+
+
+def render():
+    return registry.render()
+
+
+def debug_header(r):
+    return 'commands=%d bytes-sent=%d bytes-received=%d ms=%.2f' % (
+        r.commands, r.bytes_sent, r.bytes_received, r.seconds * 1000)
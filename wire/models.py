@@ -1,9 +1,16 @@
-import copy
-import json
+import calendar
 import re
 
 from datetime import datetime, time, date
 
+from flask import g
+from redis.exceptions import ResponseError
+
+from wire import archive
+from wire import cache
+from wire import fanout
+from wire import scripts
+from wire import storage
 from wire.utils import autoinc
 from wire.utils import Hasher
 
@@ -20,17 +27,23 @@ class Contacts:
             for c in self.redis.lrange(self.key, 0, -1)]
 
     def add(self, username):
-        r = self.redis
-        if username in self.contacts:
+        """Follows ``username``, returning their user key."""
+        contact = self.contact_key(username)
+        if contact is None:
+            self._update()
+            if username in self.contacts:
+                raise ContactExistsError()
+            raise ContactInvalidError()
+        result = scripts.call(self.redis, 'add_contact',
+            keys=[self.key, 'username:%s' % username,
+                'user:%s:followers' % contact],
+            args=[self.user.key, username, contact])
+        if result == 0:
             raise ContactExistsError()
-        if not r.exists('username:%s' % username):
+        if result == -1:
             raise ContactInvalidError()
-        r.lpush('user:%s:followers' %
-            self.contact_key(username), self.user.key)
-
-        r.lpush(self.key, username)
-        self.redis.sort(self.key, alpha=True, store=self.key)
         self._update()
+        return contact
 
     def contact_key(self, username):
         return self.redis.get('username:%s' % username)
@@ -42,16 +55,39 @@ class Contacts:
             self.contact_key(contact), self.user.key, 0)
         self._update()
 
-    def search(self, part):
-        results = []
-        users = self.redis.lrange('list:usernames', 0, -1)
+    def search(self, part, limit=10):
+        """Usernames starting with ``part`` and, for three characters or
+        more, containing it, from the indexes kept by ``index_username``."""
+        r = self.redis
         part = part.encode("UTF-8")
-        for contact in users:
-            if part in contact:
-                results.append(contact)
+        if len(part) < 1:
+            return []
+        results = r.zrangebylex('_zset:usernames', '[' + part,
+            '[' + part + '\xff', start=0, num=limit)
+        if len(results) < limit and len(part) >= 3:
+            grams = ['_set:username_grams:%s' % gram
+                for gram in _username_grams(part)]
+            infix = [username for username in r.sinter(grams)
+                if part in username and username not in results]
+            results.extend(sorted(infix)[:limit - len(results)])
         return results
 
 
+def index_username(redis, username):
+    """Adds ``username`` to the indexes contact search runs against: a
+    sorted set for prefixes, and a set per trigram for the rest."""
+    username = username.encode("UTF-8")
+    pipe = redis.pipeline(transaction=False)
+    pipe.zadd('_zset:usernames', username, 0)
+    for gram in _username_grams(username):
+        pipe.sadd('_set:username_grams:%s' % gram, username)
+    pipe.execute()
+
+
+def _username_grams(username):
+    return set(username[i:i + 3] for i in range(len(username) - 2))
+
+
 class ContactInvalidError(Exception):
     pass
 
@@ -78,19 +114,45 @@ class Event:
         self.attendees_count = 0
         self.maybes = []
         self.maybes_count = 0
+        self.state = 'unattending'
         self.creator = User(redis=redis)
         self.conversation_id = None
 
     def list(self, limit=-1, start=0):
+        """Returns a page of event summaries and the total number of events.
+
+        Summaries carry the event data and attendance counts only, fetched
+        in two pipelines; comments, creator and attendees are left for
+        ``load``.
+        """
+        r = self.redis
         if limit > 0:
-            limit = start + limit
+            stop = start + limit - 1
+        else:
+            stop = -1
+
+        keys = r.lrange('_list:events', start, stop)
 
-        keys = self.redis.lrange('_list:events', start, limit)
-        count = self.redis.llen('_list:events')
+        def read():
+            pipe = r.pipeline(transaction=False)
+            pipe.llen('_list:events')
+            for key in keys:
+                pipe.scard('event:%s:attendees' % key)
+                pipe.scard('event:%s:maybes' % key)
+            return pipe.execute()
+        results = _with_attendance(r, [k for key in keys
+            for k in _event_attendance_keys(key)], read)
+
+        count = results.pop(0)
         events = []
-        for key in keys:
-            e = Event(redis=self.redis, user=self.user)
-            e.load(key)
+        for i, data in enumerate(storage.load_many(r, 'event', keys)):
+            attendees_count, maybes_count = results[i * 2:i * 2 + 2]
+            if not data:
+                continue
+            e = Event(redis=r, user=self.user)
+            e._set_data(keys[i], data)
+            e.attendees_count = attendees_count
+            e.maybes_count = maybes_count
             events.append(e)
         return events, count
 
@@ -122,10 +184,11 @@ class Event:
             self.data['location'] = 'Undisclosed Location'
         self._load_creator()
         self.data['conversation'] = self.conversation
-        r.set('event:%s' % self.key, json.dumps(self.data))
+        storage.save(r, 'event', self.key, self.data)
 
     def _load_creator(self):
-        self.creator.load_by_username(self.data['creator'])
+        self.creator = identity_map(self.redis).get_by_username(
+            self.data['creator'])
 
     def add_comment(self, message, respond=None):
         if not self.key:
@@ -154,100 +217,113 @@ class Event:
     def load(self, event_id):
         r = self.redis
 
-        if r.exists('event:%s' % event_id):
-            self.key = event_id
-            self.data = json.loads(r.get('event:%s' % self.key))
-        else:
+        data = storage.load(r, 'event', event_id)
+        if not data:
             raise EventNotFoundError()
+        self._set_data(event_id, data)
 
-        try:
-            self.conversation_id = self.data['conversation']
-        except KeyError:
+        if not self.conversation_id:
             self.conversation_id = self.conversation
 
+        self._load_attendance()
+        self._reload_comments()
+        self._load_creator()
+
+    def _set_data(self, key, data):
+        self.key = key
+        self.data = data
+        self.conversation_id = data.get('conversation')
         if len(self.data['meeting_place']) > 0:
             self.show_meeting_place = True
         else:
             self.show_meeting_place = False
 
-        self._load_attendees_count()
-        self._load_maybes_count()
-        self._reload_comments()
-        self._load_creator()
-
     def delete(self):
         r = self.redis
         r.lrem('_list:events', self.key, 0)
-        self.load_attendees()
-        self.load_maybes()
-
-        for attendee in self.attendees:
-            r.lrem('user:%s:attending' % attendee.key, self.key, 0)
-
-        for maybe in self.maybes:
-            r.lrem('user:%s:maybe' % maybe.key, self.key, 0)
+        attendees, maybes = _with_attendance(r,
+            _event_attendance_keys(self.key),
+            lambda: [r.smembers(k) for k in _event_attendance_keys(self.key)])
+        keys = ['user:%s:attending' % key for key in attendees] + \
+            ['user:%s:maybe' % key for key in maybes]
+
+        def remove():
+            pipe = r.pipeline(transaction=False)
+            for k in keys:
+                pipe.srem(k, self.key)
+            pipe.execute()
+        _with_attendance(r, keys, remove)
 
         r.delete('event:%s' % self.key)
         r.delete('event:%s:attendees' % self.key)
         r.delete('event:%s:maybes' % self.key)
 
     def _reload_comments(self):
+        """Loads every comment with ``load_updates``, taking deleted ones
+        out of the conversation."""
         r = self.redis
         k = 'conversation:%s' % self.conversation
-        self.comments_count = r.llen(k)
-        for key in r.lrange(k, 0, -1):
-            try:
-                c = Update(redis=r, user=self.user)
-                c.load(key)
-                self.comments.append(c)
-            except UpdateError:
-                r.delete(k, key, 0)
+        keys = r.lrange(k, 0, -1)
+        self.comments = load_updates(r, keys)
+        loaded = set(c.key for c in self.comments)
+        missing = [key for key in keys if key not in loaded]
+        if missing:
+            pipe = r.pipeline(transaction=False)
+            for key in missing:
+                pipe.exists('update:%s' % key)
+            deleted = set(key for key, exists in zip(missing, pipe.execute())
+                if not exists)
+            for key in deleted:
+                r.lrem(k, key, 0)
+            keys = [key for key in keys if key not in deleted]
+        self.comments_count = len(keys)
 
     def load_attendees(self):
         r = self.redis
-        for key in r.lrange('event:%s:attendees' % self.key, 0, -1):
-            u = User(redis=self.redis)
-            u.load(key)
-            self.attendees.append(u)
+        keys = _with_attendance(r, _event_attendance_keys(self.key),
+            lambda: r.smembers('event:%s:attendees' % self.key))
+        self.attendees.extend(identity_map(r).get_many(keys).values())
         self._load_attendees_count()
 
     def load_maybes(self):
         r = self.redis
-        for key in r.lrange('event:%s:maybes' % self.key, 0, -1):
-            u = User(redis=self.redis)
-            u.load(key)
-            self.maybes.append(u)
+        keys = _with_attendance(r, _event_attendance_keys(self.key),
+            lambda: r.smembers('event:%s:maybes' % self.key))
+        self.maybes.extend(identity_map(r).get_many(keys).values())
         self._load_maybes_count()
 
     def set_attending(self):
-        if self.user.get_event_state(self.key) == 'attending':
-            return False
-        r = self.redis
-        r.lpush('event:%s:attendees' % self.key, self.user.key)
-        r.lrem('event:%s:maybes' % self.key, self.user.key, 0)
-        self.user.set_attending(self.key)
+        return self.user.set_attending(self.key)
 
     def set_unattending(self):
-        if self.user.get_event_state(self.key) == 'unattending':
-            return False
-        r = self.redis
-        r.lrem('event:%s:attendees' % self.key, self.user.key, 0)
-        r.lrem('event:%s:maybes' % self.key, self.user.key, 0)
-        self.user.set_unattending(self.key)
+        return self.user.set_unattending(self.key)
 
     def set_maybe(self):
-        if self.user.get_event_state(self.key) == 'maybe':
-            return False
-        r = self.redis
-        r.lpush('event:%s:maybes' % self.key, self.user.key)
-        r.lrem('event:%s:attendees' % self.key, self.user.key, 0)
-        self.user.set_maybe(self.key)
+        return self.user.set_maybe(self.key)
 
     def _load_attendees_count(self):
-        self.attendees_count = self.redis.llen('event:%s:attendees' % self.key)
+        self.attendees_count = _with_attendance(self.redis,
+            _event_attendance_keys(self.key),
+            lambda: self.redis.scard('event:%s:attendees' % self.key))
 
     def _load_maybes_count(self):
-        self.maybes_count = self.redis.llen('event:%s:maybes' % self.key)
+        self.maybes_count = _with_attendance(self.redis,
+            _event_attendance_keys(self.key),
+            lambda: self.redis.scard('event:%s:maybes' % self.key))
+
+    def _load_attendance(self):
+        """Loads both counts and our user's state in one round-trip."""
+        def read():
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.scard('event:%s:attendees' % self.key)
+            pipe.scard('event:%s:maybes' % self.key)
+            pipe.sismember('event:%s:attendees' % self.key, self.user.key)
+            pipe.sismember('event:%s:maybes' % self.key, self.user.key)
+            return pipe.execute()
+        self.attendees_count, self.maybes_count, attending, maybe = \
+            _with_attendance(self.redis, _event_attendance_keys(self.key),
+                read)
+        self.state = _event_state(attending, maybe)
 
     def _validate(self):
         if len(self.data['name']) < 1:
@@ -276,6 +352,63 @@ class Event:
     conversation = property(get_conversation)
 
 
+def _event_state(attending, maybe):
+    if attending:
+        return 'attending'
+    elif maybe:
+        return 'maybe'
+    else:
+        return 'unattending'
+
+
+def _event_attendance_keys(event_id):
+    return ['event:%s:attendees' % event_id, 'event:%s:maybes' % event_id]
+
+
+def _user_attendance_keys(user_key):
+    return ['user:%s:attending' % user_key, 'user:%s:maybe' % user_key]
+
+
+def _with_attendance(redis, keys, read):
+    """Returns ``read()``. If that fails on an attendance list that
+    ``migrate_attendance`` hasn't converted yet, converts whichever of
+    ``keys`` are lists and tries again."""
+    try:
+        return read()
+    except ResponseError:
+        _attendance_to_sets(redis, keys)
+        return read()
+
+
+def migrate_attendance(redis):
+    """Converts the attendance lists of every event and user to sets,
+    dropping duplicates. Returns how many lists were converted."""
+    r = redis
+    keys = []
+    for event_id in r.lrange('_list:events', 0, -1):
+        keys.extend(_event_attendance_keys(event_id))
+    for user_key in r.lrange('list:users', 0, -1):
+        keys.extend(_user_attendance_keys(user_key))
+    return _attendance_to_sets(r, keys)
+
+
+def _attendance_to_sets(redis, keys):
+    r = redis
+    converted = []
+    for k in keys:
+        def convert(pipe):
+            if pipe.type(k) != 'list':
+                return
+            members = pipe.lrange(k, 0, -1)
+            pipe.multi()
+            pipe.delete(k)
+            if members:
+                pipe.sadd(k, *members)
+            converted.append(k)
+        r.transaction(convert, k)
+    return len(converted)
+
+
 class EventNotFoundError(Exception):
     pass
 
@@ -298,24 +431,67 @@ class Inbox:
         self.threads = []
         self.redis = redis
 
-    def load_messages(self):
-        thread_keys = self.user.get_threads()
-        for thread_key in thread_keys:
-            t = Thread(redis=self.redis, user=self.user)
-            try:
-                t.load(key=thread_key)
-                t.get_unread_count()
-                self.threads.append(t)
-            except ThreadError:
-                t.delete(recipient=self.user)
+    def load_messages(self, limit=-1, start=0):
+        """Loads a page of thread summaries, most recently active first,
+        and returns the number of threads in the inbox.
 
-    def unread_count(self, thread=False):
+        Summaries come from the inbox index and each thread's summary hash,
+        in two round-trips; messages are left for ``Thread.load``. An inbox
+        that ``index_threads`` hasn't indexed yet is indexed first.
+        """
         r = self.redis
-        count = 0
-        for thread in r.lrange('user:%s:threads' % self.user.key, 0, -1):
-            t = Thread(redis=self.redis, user=self.user)
-            count += t.get_unread_count(key=thread)
-        return count
+        k = 'user:%s:inbox' % self.user.key
+        if limit > 0:
+            stop = start + limit - 1
+        else:
+            stop = -1
+
+        keys = r.zrevrange(k, start, stop)
+        pipe = r.pipeline(transaction=False)
+        pipe.sismember(INDEXED_INBOXES, self.user.key)
+        pipe.zcard(k)
+        for key in keys:
+            pipe.hgetall('thread:%s:summary' % key)
+            pipe.hget('user:%s:unreads' % self.user.key, key)
+        results = pipe.execute()
+
+        if not results.pop(0):
+            _index_inbox(r, self.user.key)
+            return self.load_messages(limit, start)
+        self.count = results.pop(0)
+        self.threads = []
+        for i, key in enumerate(keys):
+            summary, unreads = results[i * 2:i * 2 + 2]
+            if not summary:
+                r.zrem(k, key)
+                continue
+            if not summary.get('sender'):
+                continue
+            t = Thread(redis=r, user=self.user)
+            t._set_summary(key, summary)
+            t.unread_count = int(unreads or 0)
+            self.threads.append(t)
+        return self.count
+
+    def unread_count(self, thread=False):
+        """Our unread total, kept up to date as messages come and go; see
+        ``reconcile_unreads`` for repairing it. Counts from before they
+        were kept are moved over first."""
+        k = 'user:%s:unreads:total' % self.user.key
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sismember(RECONCILED_UNREADS, self.user.key)
+        pipe.get(k)
+        reconciled, count = pipe.execute()
+        if not reconciled:
+            _reconcile_unreads(self.redis, self.user.key)
+            count = self.redis.get(k)
+        return max(int(count or 0), 0)
+
+    def mark_all_read(self):
+        pipe = self.redis.pipeline()
+        pipe.delete('user:%s:unreads' % self.user.key)
+        pipe.set('user:%s:unreads:total' % self.user.key, 0)
+        pipe.execute()
 
 
 class Message:
@@ -351,7 +527,7 @@ class Message:
             'thread': self.thread,
         }
 
-        r.set('message:%s' % self.key, json.dumps(data))
+        storage.save(r, 'message', self.key, data)
 
     def delete(self):
         r = self.redis
@@ -382,18 +558,44 @@ class Message:
     def load(self, key=False):
         if key:
             self.key = key
-        if not self.redis.exists('message:%s' % self.key):
+        data = storage.load(self.redis, 'message', self.key)
+        if not data:
             raise MessageError("404, message %s not found." % self.key)
-        m = self.redis.get('message:%s' % self.key)
-        self.data = json.loads(m)
+        sender = identity_map(self.redis).get_by_username(data['sender'])
+        self._set_data(self.key, data, sender)
+
+    def _set_data(self, key, data, sender):
+        self.key = key
+        self.data = data
         self.thread = self.data['thread']
-        sender = User(redis=self.redis)
-        sender.load_by_username(self.data['sender'])
         self.sender = sender
         self.data['date_date'] = self.data['date'][:10]
         self.data['date_time'] = self.data['date'][11:16]
 
 
+def load_messages(redis, keys, user=False):
+    """Loads many messages and their senders in three round-trips, in the
+    order of ``keys``. Missing messages, and messages whose sender no
+    longer exists, are skipped."""
+    keys = list(keys)
+    if not keys:
+        return []
+    found = [(key, data) for key, data in
+        zip(keys, storage.load_many(redis, 'message', keys)) if data]
+    senders = load_users(redis, [data['sender'] for key, data in found])
+
+    messages = []
+    for key, data in found:
+        try:
+            sender = senders[data['sender']]
+        except KeyError:
+            continue
+        m = Message(redis=redis, user=user)
+        m._set_data(key, data, sender)
+        messages.append(m)
+    return messages
+
+
 class MessageValidationError(Exception):
     pass
 
@@ -467,13 +669,15 @@ class User:
             self.key = autoinc(self.redis, 'user')
             self.redis.lpush("list:users", self.key)
             self.redis.lpush("list:usernames", self.username)
+            index_username(self.redis, self.username)
 
         self.redis.set("username:%s" % self.username, self.key)
-        self.redis.set("user:%s" % self.key, json.dumps({
+        storage.save(self.redis, 'user', self.key, {
             'username': self.username,
             'password': self.password,
             'avatar': self.avatar
-        }))
+        })
+        cache.invalidate(self.redis, self.key, self.username)
 
     def _validate(self):
         errors = []
@@ -511,10 +715,13 @@ class User:
             raise UserExists()
 
     def load(self, key):
-        if not self.redis.exists('user:%s' % key):
+        data = storage.load(self.redis, 'user', key)
+        if not data:
             raise UserNotFoundError
+        self._set_data(key, data)
+
+    def _set_data(self, key, data):
         self.key = key
-        data = json.loads(self.redis.get('user:%s' % key))
         self.data = data
         self.password = data['password']
         self.username = data['username']
@@ -524,31 +731,31 @@ class User:
             self.avatar = 'default.png'
 
     def set_attending(self, event_id):
-        r = self.redis
-        r.lpush('user:%s:attending' % self.key, event_id)
-        r.lrem('user:%s:maybe' % self.key, event_id, 0)
+        return self._rsvp(event_id, 'attending')
 
     def set_maybe(self, event_id):
-        r = self.redis
-        r.lpush('user:%s:maybe' % self.key, event_id)
-        r.lrem('user:%s:attending' % self.key, event_id, 0)
+        return self._rsvp(event_id, 'maybe')
 
     def set_unattending(self, event_id):
-        r = self.redis
-        r.lrem('user:%s:attending' % self.key, event_id, 0)
-        r.lrem('user:%s:maybe' % self.key, event_id, 0)
+        return self._rsvp(event_id, 'unattending')
+
+    def _rsvp(self, event_id, state):
+        """Sets our state for an event on both the event's and our sets,
+        returning False if it was already set."""
+        keys = _event_attendance_keys(event_id) + \
+            _user_attendance_keys(self.key)
+        return _with_attendance(self.redis, keys,
+            lambda: scripts.call(self.redis, 'rsvp', keys=keys,
+                args=[self.key, event_id, state])) > 0
 
     def get_event_state(self, event_id):
-        r = self.redis
-        event_id = str(event_id)
-        print r.lrange('user:%s:attending' % self.key, 0, -1), event_id
-        print event_id in r.lrange('user:%s:attending' % self.key, 0, -1)
-        if event_id in r.lrange('user:%s:attending' % self.key, 0, -1):
-            return 'attending'
-        elif event_id in r.lrange('user:%s:maybe' % self.key, 0, -1):
-            return 'maybe'
-        else:
-            return 'unattending'
+        def read():
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.sismember('user:%s:attending' % self.key, event_id)
+            pipe.sismember('user:%s:maybe' % self.key, event_id)
+            return pipe.execute()
+        return _event_state(*_with_attendance(self.redis,
+            _user_attendance_keys(self.key), read))
 
     def get_contacts(self):
         c = Contacts(redis=self.redis, user=self)
@@ -557,13 +764,9 @@ class User:
     contacts = property(get_contacts)
 
     def get_followers(self):
-        r = self.redis
-        followers = []
-        for follower in r.lrange('user:%s:followers' % self.key, 0, -1):
-            u = User(redis=self.redis)
-            u.load(follower)
-            followers.append(u)
-        return followers
+        keys = self.redis.lrange('user:%s:followers' % self.key, 0, -1)
+        users = identity_map(self.redis).get_many(keys)
+        return [users[key] for key in keys if key in users]
 
     followers = property(get_followers)
 
@@ -586,6 +789,98 @@ class User:
     posted = property(get_posted)
 
 
+def load_users(redis, usernames):
+    """Loads many users by username in at most two round-trips, returning
+    a dict of username to User. Usernames that don't resolve are left out."""
+    return identity_map(redis).get_many_by_username(usernames)
+
+
+class UserMap:
+    """The users loaded so far, by key and by username, so that each is
+    loaded at most once, and those not yet loaded are fetched in one
+    round-trip.
+
+    The frontend keeps one on ``flask.g`` for the length of a request; see
+    ``identity_map``. Users that don't exist are remembered as well.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.by_key = {}
+        self.keys = {}
+
+    def add(self, user):
+        self.by_key[str(user.key)] = user
+        self.keys[user.username] = str(user.key)
+
+    def get(self, key):
+        try:
+            return self.get_many([key])[str(key)]
+        except KeyError:
+            raise UserNotFoundError
+
+    def get_by_username(self, username):
+        try:
+            return self.get_many_by_username([username])[username]
+        except KeyError:
+            raise UserNotFoundError
+
+    def get_many(self, keys):
+        """Returns a dict of key to User for whichever of ``keys`` exist."""
+        keys = set(str(key) for key in keys)
+        missing = [key for key in keys if key not in self.by_key]
+        if missing:
+            profiles = self._fetch(['user:%s' % key for key in missing],
+                lambda keys: storage.load_many(self.redis, 'user',
+                    [k.split(':', 1)[1] for k in keys]))
+            for key, data in zip(missing, profiles):
+                if not data:
+                    self.by_key[key] = None
+                    continue
+                u = User(redis=self.redis)
+                # Cached profiles are shared; don't let users change them.
+                u._set_data(key, dict(data))
+                self.add(u)
+        return dict((key, self.by_key[key]) for key in keys
+            if self.by_key[key])
+
+    def get_many_by_username(self, usernames):
+        """Returns a dict of username to User for whichever of ``usernames``
+        exist."""
+        usernames = set(usernames)
+        missing = [username for username in usernames
+            if username not in self.keys]
+        if missing:
+            keys = self._fetch(['username:%s' % username
+                for username in missing], self.redis.mget)
+            for username, key in zip(missing, keys):
+                self.keys[username] = key
+        found = [(username, self.keys[username]) for username in usernames
+            if self.keys[username]]
+        users = self.get_many(key for username, key in found)
+        return dict((username, users[key]) for username, key in found
+            if key in users)
+
+    def _fetch(self, keys, load):
+        """Gets ``keys`` from the profile cache, or by calling ``load`` with
+        those it doesn't have."""
+        values = cache.get_many(self.redis.connection_pool, keys)
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if missing:
+            fetched = dict(zip(missing, load(missing)))
+            cache.set_many(fetched.items())
+            values = [fetched.get(key, value)
+                for key, value in zip(keys, values)]
+        return values
+
+
+def identity_map(redis):
+    """The request's UserMap, or a new one outside of requests."""
+    try:
+        return g.users
+    except (AttributeError, RuntimeError):
+        return UserMap(redis)
+
+
 class UserValidationError(Exception):
     pass
 
@@ -599,6 +894,12 @@ class UserExists(Exception):
 
 
 class Update:
+    # Push new updates to followers from a fanout worker rather than
+    # inside the request.
+    async_fanout = False
+    # Followers above which an author's updates are pulled, not pushed.
+    pull_threshold = None
+
     def __init__(self, text=None, redis=None,
         user=None, key=None, respond="", event=None, conversation=None):
 
@@ -618,7 +919,7 @@ class Update:
         else:
             self.respond = None
 
-        self.done_keys = []
+        self.done_keys = set()
         self.text = text
         self.event = event
         if self.text:
@@ -633,37 +934,39 @@ class Update:
 
         self._get_conversation()
 
-        r.set('update:%s' % self.key, self.json)
+        storage.save(r, 'update', self.key, self.data_dict)
 
         if self.event:
             self._update_event()
         else:
-            self._update_followers()
             self._update_timeline()
         self._update_conversation()
         self._update_mentions()
+        if not self.event:
+            self._update_followers()
 
     def load(self, key):
         r = self.redis
 
-        if not r.exists('update:%s' % key):
+        data = storage.load(r, 'update', key)
+        if not data:
             raise UpdateError()
 
-        self.key = key
-        data = json.loads(r.get('update:%s' % self.key))
+        u = identity_map(r).get_by_username(data['username'])
+        event_name = None
+        if data.get('event'):
+            event_name = storage.load(r, 'event', data['event'],
+                ['name'])['name']
+        self._set_data(key, data, u, event_name)
 
+    def _set_data(self, key, data, user, event_name=None):
+        self.key = key
         self.hashes = data['hashes']
         self.text = data['text']
-        u = User(redis=self.redis)
-        u.load_by_username(data['username'])
-        self.user = u
-        try:
-            self.event = data['event']
-            if self.event:
-                self.data['event_name'] = json.loads(
-                    r.get('event:%s' % self.event))['name']
-        except KeyError:
-            self.event = None
+        self.user = user
+        self.event = data.get('event')
+        if self.event:
+            self.data['event_name'] = event_name
         self.mentions = data['mentions']
         self.respond = data['respond']
         try:
@@ -679,39 +982,38 @@ class Update:
         if not self.key:
             return None
 
-        if self.event:
-            self._del_event()
-        else:
+        if not self.event:
             self._del_followers()
-            self._del_timeline()
-        self._del_mentions()
-        self._del_conversation()
 
-        r.delete('update:%s' % self.key)
-
-    def _del_event(self):
-        self.redis.lrem('event:%s:comments' % self.event, self.key, 0)
+        if self.event:
+            is_event = '1'
+        else:
+            is_event = ''
+        mentioned = []
+        if self.mentions:
+            for key in r.mget(['username:%s' % m for m in self.mentions]):
+                if key:
+                    mentioned.extend(['user:%s:timeline' % key,
+                        'user:%s:mentions' % key])
+        scripts.call(r, 'delete_update', keys=[
+            'update:%s' % self.key,
+            'user:%s:timeline' % self.user.key,
+            'user:%s:updates' % self.user.key,
+            'conversation:%s' % self.conversation,
+            fanout.pulled_key(self.user.key),
+            'event:%s:comments' % self.event,
+            'fragment:update:%s' % self.key
+        ] + mentioned, args=[self.key, is_event])
 
     def _del_followers(self):
         r = self.redis
-        for follower in self.user.followers:
-            r.lrem('user:%s:timeline' % follower.key, self.key, 0)
-
-    def _del_mentions(self):
-        r = self.redis
-        for mentionee in self.mentions:
-            key = r.get('username:%s' % mentionee)
-            r.lrem('user:%s:timeline' % key, self.key, 0)
-            r.lrem('user:%s:mentions' % key, self.key, 0)
-
-    def _del_timeline(self):
-        r = self.redis
-        r.lrem('user:%s:timeline' % self.user.key, self.key, 0)
-        r.lrem('user:%s:updates' % self.user.key, self.key, 0)
-
-    def _del_conversation(self):
-        r = self.redis
-        r.lrem('conversation:%s' % self.conversation, self.key, 0)
+        since = r.hget(fanout.PULLED_SINCE, self.user.key)
+        if since and int(self.key) >= int(since):
+            return
+        pipe = r.pipeline(transaction=False)
+        for follower in r.lrange('user:%s:followers' % self.user.key, 0, -1):
+            pipe.lrem('user:%s:timeline' % follower, self.key, 0)
+        pipe.execute()
 
     def parse(self, text):
         for match in re.finditer('(#[^\s]+)', text):
@@ -735,14 +1037,13 @@ class Update:
             self.conversation = autoinc(self.redis, 'conversation')
 
     def _update_followers(self):
-        r = self.redis
-        for follower in self.user.followers:
-            if follower.key == self.user.key:
-                continue
-            if follower.key in self.done_keys:
-                continue
-            self.done_keys.append(follower.key)
-            r.lpush('user:%s:timeline' % follower.key, self.key)
+        if self.async_fanout:
+            fanout.enqueue(self.redis, self.key, self.user.key,
+                skip=self.done_keys, threshold=self.pull_threshold)
+        else:
+            fanout.fan_out(self.redis, fanout.make_job(self.key,
+                self.user.key, skip=self.done_keys,
+                threshold=self.pull_threshold))
 
     def _update_mentions(self):
         r = self.redis
@@ -752,21 +1053,24 @@ class Update:
                 continue
             if key in self.done_keys:
                 continue
-            self.done_keys.append(key)
-            r.lpush('user:%s:mentions' % key, self.key)
+            self.done_keys.add(key)
+            k = 'user:%s:mentions' % key
+            archive.trim(r, k, r.lpush(k, self.key))
             r.incr('user:%s:mentions:unread' % key)
             if key == self.user.key:
                 continue
 
-            r.lpush('user:%s:timeline' % key, self.key)
+            k = 'user:%s:timeline' % key
+            archive.trim(r, k, r.lpush(k, self.key))
 
     def _update_timeline(self):
         r = self.redis
-        r.lpush('user:%s:timeline' % self.user.key, self.key)
-        r.lpush('user:%s:updates' % self.user.key, self.key)
+        for name in ['timeline', 'updates']:
+            k = 'user:%s:%s' % (self.user.key, name)
+            archive.trim(r, k, r.lpush(k, self.key))
 
-    def get_data_json(self):
-        return json.dumps({
+    def get_data_dict(self):
+        return {
             'username': self.user.username,
             'text': self.text,
             'mentions': self.mentions,
@@ -775,9 +1079,41 @@ class Update:
             'datetime': self.datetime,
             'conversation': self.conversation,
             'event': self.event
-        })
+        }
 
-    json = property(get_data_json)
+    data_dict = property(get_data_dict)
+
+
+def load_updates(redis, keys):
+    """Loads many updates, their authors and event names in a fixed number
+    of round-trips however many keys there are. Missing updates, and
+    updates whose author no longer exists, are skipped."""
+    keys = list(keys)
+    if not keys:
+        return []
+    found = [(key, data) for key, data in
+        zip(keys, storage.load_many(redis, 'update', keys)) if data]
+    users = load_users(redis, [data['username'] for key, data in found])
+
+    event_ids = list(set(data['event'] for key, data in found
+        if data.get('event')))
+    event_names = {}
+    if event_ids:
+        events = storage.load_many(redis, 'event', event_ids, ['name'])
+        for event_id, event in zip(event_ids, events):
+            if event:
+                event_names[event_id] = event['name']
+
+    updates = []
+    for key, data in found:
+        try:
+            user = users[data['username']]
+        except KeyError:
+            continue
+        u = Update(redis=redis, user=user)
+        u._set_data(key, data, user, event_names.get(data.get('event')))
+        updates.append(u)
+    return updates
 
 
 class UpdateError(Exception):
@@ -800,9 +1136,9 @@ class Timeline:
     def rebuild(self):
         self.update_cache = []
         self.update_keys = []
-        for contact in self.user.contacts:
-            u = User(redis=self.redis)
-            u.load_by_username(contact)
+        contacts = identity_map(self.redis).get_many_by_username(
+            self.user.contacts)
+        for u in contacts.values():
             for update in u.posted.updates:
                 self.add(update)
 
@@ -814,20 +1150,138 @@ class Timeline:
             key=lambda x: int(x.key), reverse=True)
         self.save_rebuilt()
 
+    def merge_user(self, user_key):
+        """Merges everything ``user_key`` has posted into this timeline,
+        after following them, archived updates included. Works on update
+        ids only."""
+        r = self.redis
+        k = 'user:%s:updates' % user_key
+        posted = set(r.lrange(k, 0, -1)) | set(archive.get_all(r, k))
+        if not posted:
+            return
+
+        def merge(keys):
+            return set(keys) | posted
+        self._rewrite(merge)
+
+    def remove_user(self, user_key):
+        """Takes everything ``user_key`` has posted out of this timeline and
+        its archive, after unfollowing them, except updates that mention our
+        user."""
+        r = self.redis
+        k = 'user:%s:updates' % user_key
+        posted = set(r.lrange(k, 0, -1)) | set(archive.get_all(r, k))
+        k = 'user:%s:mentions' % self.user.key
+        posted -= set(r.lrange(k, 0, -1)) | set(archive.get_all(r, k))
+        if not posted:
+            return
+
+        def remove(keys):
+            return set(keys) - posted
+        self._rewrite(remove)
+        archive.remove(r, 'user:%s:%s' % (self.user.key, self.type), posted)
+
+    def _rewrite(self, change):
+        k = 'user:%s:%s' % (self.user.key, self.type)
+        overflow = []
+        newest = None
+        archived = archive.get_range(self.redis, k, 0, 1)
+        if archived:
+            newest = archived[0]
+
+        def rewrite(pipe):
+            keys = change(pipe.lrange(k, 0, -1))
+            keys, overflow[:] = archive.split(
+                sorted(keys, key=int, reverse=True), newest)
+            pipe.multi()
+            pipe.delete(k)
+            if keys:
+                pipe.rpush(k, *keys)
+        self.redis.transaction(rewrite, k)
+        if overflow:
+            archive.merge(self.redis, k, overflow)
+
     def save_rebuilt(self):
         r = self.redis
-        r.delete('user:%s:timeline' % self.user.key)
-        for update in self.update_cache:
-            r.rpush('user:%s:timeline' % self.user.key, update.key)
+        k = 'user:%s:timeline' % self.user.key
+        keys, overflow = archive.split(
+            [update.key for update in self.update_cache])
+        r.delete(k)
+        for key in keys:
+            r.rpush(k, key)
+        if overflow:
+            archive.merge(r, k, overflow)
 
     def get_updates(self):
+        """Loads every update in the list, leaving out its archive."""
+        keys = self.redis.lrange('user:%s:%s' %
+            (self.user.key, self.type), 0, -1)
+        return load_updates(self.redis, keys)
+
+    def get_page(self, before=None, offset=0, limit=30):
+        """Returns a page of at most ``limit`` updates older than update
+        ``before``, and the cursor for the page after it (None at the end).
+
+        ``offset`` is only a hint of where ``before`` sat in the list. The
+        list is newest first, so updates pushed since only move it further
+        along; we back off by a page to cover deletions too, and skip
+        anything not older than ``before``.
+
+        Pages carry on into the list's archive past its end, see
+        ``archive``. Timelines also pull in updates from followed users with
+        too many followers to push to, see ``fanout.pull``. One update past
+        the page is read from each, so that the last page has no cursor.
+        """
         r = self.redis
-        updates = []
-        for update in r.lrange('user:%s:%s' %
-                (self.user.key, self.type), 0, -1):
-            u = Update(redis=self.redis, key=update, user=self.user)
-            updates.append(u)
-        return updates
+        k = 'user:%s:%s' % (self.user.key, self.type)
+        if before:
+            offset = max(0, offset - limit)
+        else:
+            offset = 0
+
+        keys = []
+        # Where each id read from the list ends, for the next page's hint.
+        ends = {}
+        start = offset
+        while len(keys) <= limit:
+            chunk = self._chunk(k, offset, limit + 1)
+            for key in chunk:
+                offset += 1
+                if before and int(key) >= before:
+                    continue
+                keys.append(key)
+                ends[key] = offset
+                if len(keys) > limit:
+                    break
+            if len(chunk) <= limit:
+                break
+
+        if self.type == 'timeline':
+            pulled = fanout.pull(r, self.user.contacts, before, limit + 1)
+            if pulled:
+                keys = sorted(set(keys) | set(pulled), key=int, reverse=True)
+
+        cursor = None
+        if len(keys) > limit:
+            keys = keys[:limit]
+            cursor = {
+                'before': int(keys[-1]),
+                'offset': max([ends[key] for key in keys if key in ends] or
+                    [start])
+            }
+        return load_updates(self.redis, keys), cursor
+
+    def _chunk(self, k, start, count):
+        """Up to ``count`` ids from ``start`` on, in the list and then on
+        in its archive."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lrange(k, start, start + count - 1)
+        pipe.llen(k)
+        chunk, length = pipe.execute()
+        if len(chunk) < count:
+            chunk += archive.get_range(self.redis, k,
+                max(0, start - length), count - len(chunk))
+        return chunk
 
     updates = property(get_updates)
 
@@ -844,13 +1298,18 @@ class Thread:
         self.key = False
         self.unread_count = 0
         self.encryption = None
+        self.message_count = 0
+        self.older = None
+        self.last_sender = None
+        self.last_snippet = ''
+        self.last_date = None
 
     def get_unread_count(self, key=False):
         if not key:
             key = self.key
         try:
-            count = int(self.redis.get('user:%s:thread:%s:unreads' % \
-                (self.user.key, key)))
+            count = int(self.redis.hget('user:%s:unreads' % self.user.key,
+                key))
         except TypeError:
             count = 0
         self.unread_count = count
@@ -864,19 +1323,25 @@ class Thread:
         return result
 
     def reset_unread_count(self):
-        self.redis.set('user:%s:thread:%s:unreads' % \
-            (self.user.key, self.key), 0)
+        self._clear_unreads(self.user.key)
+
+    def _clear_unreads(self, user_key):
+        scripts.call(self.redis, 'clear_unreads', keys=[
+            'user:%s:unreads' % user_key,
+            'user:%s:unreads:total' % user_key
+        ], args=[self.key])
 
     def _update_recipients(self):
         r = self.redis
         self.recipients = []
         self.recipients = r.lrange('thread:%s:recipients' % self.key, 0, -1)
         self.recipient_usernames = []
-        for rec in self.recipients:
+        if not self.recipients:
+            return
+        users = storage.load_many(r, 'user', self.recipients, ['username'])
+        for rec, user in zip(self.recipients, users):
             try:
-                self.recipient_usernames.append(json.loads( \
-                    r.get('user:%s' % rec) \
-                    )['username'])
+                self.recipient_usernames.append(user['username'])
             except TypeError:
                 r.lrem('thread:%s:recipients' % self.key, rec, 0)
 
@@ -914,17 +1379,82 @@ class Thread:
             raise ValidationError()
 
     def _sync_recipients(self):
-        r = self.redis
-        new_recipients = copy.deepcopy(self.recipients)
+        keys = ['thread:%s:recipients' % self.key]
+        for recipient in self.recipients:
+            keys.extend(['user:%s:threads' % recipient,
+                'user:%s:inbox' % recipient,
+                'user:%s:unreads' % recipient,
+                'user:%s:unreads:total' % recipient])
+        scripts.call(self.redis, 'sync_recipients', keys=keys,
+            args=[self.key, self.message_count, _activity(datetime.now())] +
+                list(self.recipients))
         self._update_recipients()
-        for recipient in new_recipients:
-            if recipient not in self.recipients:
-                r.rpush('thread:%s:recipients' % self.key, recipient)
-                r.lpush('user:%s:threads' % recipient, self.key)
-                r.incr('user:%s:thread:%s:unreads' % \
-                    (recipient, self.key), len(self.messages))
 
-        del new_recipients
+    def _set_summary(self, key, summary):
+        self.key = key
+        self.subject = summary.get('subject', '')
+        self.encryption = summary.get('encryption') or 'plain'
+        self.sender = summary.get('sender')
+        self.message_count = int(summary.get('count', 0))
+        self.last_sender = summary.get('last_sender')
+        self.last_snippet = summary.get('last_snippet', '')
+        self.last_date = summary.get('last_date')
+
+    def _snippet(self, content):
+        # Encrypted content means nothing until the reader decrypts it.
+        if self.encryption != 'plain':
+            return ''
+        return content[:100]
+
+    def _touch(self, message):
+        """Records ``message`` as the latest in our summary and moves the
+        thread to the top of every recipient's inbox."""
+        k = 'thread:%s:summary' % self.key
+        pipe = self.redis.pipeline()
+        pipe.hsetnx(k, 'sender', message.user.username)
+        pipe.hmset(k, {
+            'last_sender': message.user.username,
+            'last_snippet': self._snippet(message.data.get('content', '')),
+            'last_date': message.date
+        })
+        pipe.hincrby(k, 'count', 1)
+        activity = _activity(message.date)
+        for recipient in self.recipients:
+            pipe.zadd('user:%s:inbox' % recipient, self.key, activity)
+        pipe.execute()
+
+    def _refresh_summary(self):
+        """Works our summary's message fields out again from the first and
+        last messages, returning the last message's date."""
+        r = self.redis
+        k = 'thread:%s:messages' % self.key
+        pipe = r.pipeline(transaction=False)
+        pipe.llen(k)
+        pipe.lindex(k, 0)
+        pipe.lindex(k, -1)
+        count, first, last = pipe.execute()
+        if not count:
+            return None
+        first, last = storage.load_many(r, 'message', [first, last],
+            ['sender', 'content', 'date'])
+        summary = {'count': count}
+        if first:
+            summary['sender'] = first['sender']
+        if last:
+            summary['last_sender'] = last['sender']
+            summary['last_snippet'] = self._snippet(last['content'])
+            summary['last_date'] = last['date']
+        r.hmset('thread:%s:summary' % self.key, summary)
+        return summary.get('last_date')
+
+    def _move_in_inboxes(self, last_date):
+        """Moves the thread to ``last_date`` in every recipient's inbox."""
+        r = self.redis
+        activity = _activity(last_date)
+        pipe = r.pipeline(transaction=False)
+        for recipient in r.lrange('thread:%s:recipients' % self.key, 0, -1):
+            pipe.zadd('user:%s:inbox' % recipient, self.key, activity)
+        pipe.execute()
 
     def save(self):
         r = self.redis
@@ -936,7 +1466,11 @@ class Thread:
             'encryption': self.encryption
         }
 
-        r.set('thread:%s:data' % self.key, json.dumps(data))
+        storage.save(r, 'thread', self.key, data)
+        r.hmset('thread:%s:summary' % self.key, {
+            'subject': self.subject,
+            'encryption': self.encryption or 'plain'
+        })
 
         self._sync_recipients()
         for message in self.queued_messages:
@@ -944,7 +1478,7 @@ class Thread:
 
     def add_message(self, m):
         m.get_key()
-        if len(self.messages) == 0:
+        if not self.key:
             self.save()
 
         if self.key:
@@ -956,63 +1490,111 @@ class Thread:
 
     def _commit_message(self, message):
         self.redis.rpush('thread:%s:messages' % self.key, message.get_key())
+        self.message_count += 1
         self._incr_unreads()
+        self._touch(message)
 
     def _incr_unreads(self):
+        pipe = self.redis.pipeline()
         for recipient in self.recipients:
             if recipient != self.user.key:
-                self.redis.incr('user:%s:thread:%s:unreads' \
-                    % (recipient, self.key))
+                pipe.hincrby('user:%s:unreads' % recipient, self.key, 1)
+                pipe.incr('user:%s:unreads:total' % recipient)
+        pipe.execute()
 
     def delete_message(self, message):
         r = self.redis
         r.lrem('thread:%s:messages' % self.key, message.key, 0)
-        self.messages = r.lrange('thread:%s:messages' % self.key, 0, -1)
-        if not self.messages or len(self.messages) < 1:
+        self.message_count = r.llen('thread:%s:messages' % self.key)
+        if self.message_count < 1:
             self.delete()
-
-    def load(self, key):
+            return
+        last_date = self._refresh_summary()
+        if last_date:
+            self._move_in_inboxes(last_date)
+
+    def load(self, key, limit=-1):
+        """Loads the thread and its latest ``limit`` messages; every message
+        when ``limit`` is negative, and none at all when it is 0. Use
+        ``get_messages`` for older messages."""
+        r = self.redis
         self.messages = []
+        self.older = None
         self.key = key
-        message_keys = self.redis.lrange('thread:%s:messages' % key, 0, -1)
+        pipe = r.pipeline(transaction=False)
+        pipe.llen('thread:%s:messages' % key)
+        pipe.hget('thread:%s:summary' % key, 'sender')
+        self.message_count, self.sender = pipe.execute()
+        data = storage.load(r, 'thread', key)
         self._update_recipients()
-        data = self.redis.get('thread:%s:data' % key)
         if not data:
             raise ThreadError("Thread %s data doesn't exist." % self.key)
-        data = json.loads(data)
         self.subject = data['subject']
         try:
             self.encryption = data['encryption']
         except KeyError:
             self.encryption = 'plain'
-        for message_key in message_keys:
-            m = Message(redis=self.redis, user=self.user)
-            try:
-                m.load(message_key)
-            except MessageError:
-                pass
-            self.messages.append(m)
-        if len(self.messages) < 1:
+        if self.message_count < 1:
             self.delete()
             raise DestroyedThreadError
-        try:
-            self.sender = self.messages[0].data['sender']
-        except KeyError:
-            self.delete_message(self.messages[0])
+        if limit:
+            self.messages, self.older = self.get_messages(limit=limit)
+
+    def get_messages(self, before=None, index=None, limit=30):
+        """Returns up to ``limit`` messages older than message ``before``,
+        oldest first, and the cursor for the ones before them (None when
+        there are none). Without ``before``, returns our latest messages.
+
+        ``index`` is only a hint of where ``before`` sat in our list.
+        Messages are appended, so only deletions can move it, and only
+        nearer the start; we skip anything not older than ``before``.
+        """
+        r = self.redis
+        k = 'thread:%s:messages' % self.key
+        if limit < 0:
+            return load_messages(r, r.lrange(k, 0, -1), self.user), None
+
+        if before is None or index is None:
+            before = None
+            index = r.llen(k)
+
+        keys = []
+        first = start = index
+        while start > 0 and len(keys) < limit:
+            stop = start
+            start = max(0, stop - limit)
+            chunk = r.lrange(k, start, stop - 1)
+            for i in range(len(chunk) - 1, -1, -1):
+                if before and int(chunk[i]) >= before:
+                    continue
+                keys.insert(0, chunk[i])
+                first = start + i
+                if len(keys) == limit:
+                    break
+
+        cursor = None
+        if keys and first > 0:
+            cursor = {'before': int(keys[0]), 'index': first}
+        return load_messages(r, keys, self.user), cursor
 
     def delete(self, recipient=False):
         r = self.redis
         if recipient:
             r.lrem('user:%s:threads' % recipient.key, self.key, 0)
+            r.zrem('user:%s:inbox' % recipient.key, self.key)
+            self._clear_unreads(recipient.key)
         if self.recipients:
             for recipient_key in self.recipients:
                 r.lrem('user:%s:threads' % recipient_key, self.key, 0)
-                r.delete('user:%s:thread:%s:unreads' % \
-                    (recipient_key, self.key))
+                r.zrem('user:%s:inbox' % recipient_key, self.key)
+                self._clear_unreads(recipient_key)
 
-        [m.delete() for m in self.messages]
+        message_keys = r.lrange('thread:%s:messages' % self.key, 0, -1)
+        if message_keys:
+            r.delete(*['message:%s' % key for key in message_keys])
 
         r.delete('thread:%s:data' % self.key)
+        r.delete('thread:%s:summary' % self.key)
         r.delete('thread:%s:recipients' % self.key)
         r.delete('thread:%s:messages' % self.key)
 
@@ -1020,11 +1602,129 @@ class Thread:
         r = self.redis
         r.lrem('thread:%s:recipients' % self.key, self.user.key, 0)
         r.lrem('user:%s:threads' % self.user.key, self.key, 0)
+        r.zrem('user:%s:inbox' % self.user.key, self.key)
+        self._clear_unreads(self.user.key)
         self._update_recipients()
         if len(self.recipients) < 1:
             self.delete()
 
 
+def _activity(date):
+    """Turns a date, or the string of one that messages keep, into the
+    score threads are ordered by in inboxes."""
+    if not isinstance(date, datetime):
+        format = '%Y-%m-%d %H:%M:%S'
+        if '.' in date:
+            format += '.%f'
+        date = datetime.strptime(date, format)
+    return calendar.timegm(date.timetuple()) + date.microsecond / 1e6
+
+
+# Users whose threads are all in their inbox index.
+INDEXED_INBOXES = '_set:indexed_inboxes'
+
+
+def index_threads(redis):
+    """Builds inbox indexes and thread summaries for threads from before
+    they were kept. Returns how many threads were indexed."""
+    r = redis
+    thread_keys = set()
+    user_keys = r.lrange('list:users', 0, -1)
+    for user_key in user_keys:
+        thread_keys.update(r.lrange('user:%s:threads' % user_key, 0, -1))
+
+    count = 0
+    for key in thread_keys:
+        if _index_thread(r, key):
+            count += 1
+    if user_keys:
+        r.sadd(INDEXED_INBOXES, *user_keys)
+    return count
+
+
+def _index_inbox(redis, user_key):
+    """Indexes the threads of one user, and their summaries, as
+    ``index_threads`` does for everyone."""
+    for key in redis.lrange('user:%s:threads' % user_key, 0, -1):
+        _index_thread(redis, key)
+    redis.sadd(INDEXED_INBOXES, user_key)
+
+
+def _index_thread(redis, key):
+    r = redis
+    data = storage.load(r, 'thread', key)
+    if not data:
+        return False
+    t = Thread(redis=r)
+    t.key = key
+    t.encryption = data.get('encryption') or 'plain'
+    r.hmset('thread:%s:summary' % key, {
+        'subject': data['subject'],
+        'encryption': t.encryption
+    })
+    last_date = t._refresh_summary()
+    if not last_date:
+        return False
+    t._move_in_inboxes(last_date)
+    return True
+
+
+# Users whose old per-thread unread counts have been moved into their hash.
+RECONCILED_UNREADS = '_set:reconciled_unreads'
+
+
+def reconcile_unreads(redis):
+    """Rebuilds every user's unread total from their per-thread counts.
+
+    Counts for threads the user has left are dropped, and counts still kept
+    under the old ``user:N:thread:T:unreads`` keys are added to the user's
+    hash. Returns how many totals were wrong.
+    """
+    r = redis
+    repaired = 0
+    for user_key in r.lrange('list:users', 0, -1):
+        if _reconcile_unreads(r, user_key):
+            repaired += 1
+    return repaired
+
+
+def _reconcile_unreads(redis, user_key):
+    """Rebuilds one user's unread total, returning whether it was wrong."""
+    r = redis
+    k = 'user:%s:unreads' % user_key
+    total_key = 'user:%s:unreads:total' % user_key
+    threads = r.lrange('user:%s:threads' % user_key, 0, -1)
+    old_keys = ['user:%s:thread:%s:unreads' % (user_key, thread)
+        for thread in threads]
+
+    def reconcile(pipe):
+        counts = pipe.hgetall(k)
+        old_counts = []
+        if old_keys:
+            old_counts = pipe.mget(old_keys)
+        total = pipe.get(total_key)
+        counts = dict((thread, int(count))
+            for thread, count in counts.items())
+        # Messages since the hash was introduced were counted in it, and
+        # those before only under the old keys, so both add up.
+        for thread, count in zip(threads, old_counts):
+            if count is not None:
+                counts[thread] = counts.get(thread, 0) + int(count)
+        counts = dict((thread, count) for thread, count in counts.items()
+            if thread in threads and count > 0)
+        pipe.multi()
+        pipe.delete(k)
+        if counts:
+            pipe.hmset(k, counts)
+        pipe.set(total_key, sum(counts.values()))
+        if old_keys:
+            pipe.delete(*old_keys)
+        pipe.sadd(RECONCILED_UNREADS, user_key)
+        return int(total or 0) != sum(counts.values())
+    return r.transaction(reconcile, k, total_key, *old_keys,
+        value_from_callable=True)
+
+
 class DestroyedThreadError(Exception):
     pass
 
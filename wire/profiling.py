@@ -0,0 +1,238 @@
+"""Stack samples of slow requests, and summaries of them.
+
+``start`` registers the request a thread is handling. A sampler thread, one
+per process, wakes every ``interval`` seconds and records the stack of each
+request that has been running for longer than ``threshold``. It sleeps until
+the oldest request could be slow, and while there are none at all.
+``finish`` writes a slow request's samples to ``directory`` as JSON, keeping
+the newest ``keep`` files. Requests faster than the threshold are never
+sampled, so this is cheap enough to leave on.
+
+``summarize`` reads the samples back for ``manage.py slow-requests``.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from timeit import default_timer
+
+# Frames deeper than this are left out of samples.
+MAX_DEPTH = 100
+
+log = logging.getLogger('wire.profiling')
+
+_package = os.path.dirname(os.path.abspath(__file__))
+
+
+class SlowRequests:
+    # Set from config by create_app. A threshold of None turns sampling off.
+    threshold = 1.0
+    interval = 0.01
+    directory = 'slow_requests'
+    keep = 200
+
+
+_requests = {}
+_lock = threading.Lock()
+# Set while any request is being handled.
+_active = threading.Event()
+_sampler_pid = None
+_filenames = {}
+
+
+def start(endpoint, method, path):
+    """Watches the request this thread is about to handle."""
+    if SlowRequests.threshold is None:
+        return
+    _sampler()
+    with _lock:
+        _requests[threading.current_thread().ident] = {
+            'endpoint': endpoint or 'unknown',
+            'method': method,
+            'path': path,
+            'started': default_timer(),
+            'samples': 0,
+            'stacks': {}
+        }
+        _active.set()
+
+
+def finish(duration, status):
+    """Stops watching this thread's request, writing out its samples if it
+    took long enough to have any. Returns the file written, or None."""
+    with _lock:
+        request = _requests.pop(threading.current_thread().ident, None)
+        if not _requests:
+            _active.clear()
+    if not request or not request['samples']:
+        return None
+    dump = {
+        'endpoint': request['endpoint'],
+        'method': request['method'],
+        'path': request['path'],
+        'status': status,
+        'date': time.time(),
+        'duration': duration,
+        'threshold': SlowRequests.threshold,
+        'interval': SlowRequests.interval,
+        'samples': request['samples'],
+        'stacks': [{'frames': list(stack), 'count': count}
+            for stack, count in request['stacks'].items()]
+    }
+    try:
+        return _write(dump)
+    except (IOError, OSError):
+        log.exception("Couldn't save the samples of a slow request.")
+
+
+def _write(dump):
+    directory = SlowRequests.directory
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = os.path.join(directory, '%.6f-%d.json' % (dump['date'],
+        os.getpid()))
+    partial = filename + '.tmp'
+    with open(partial, 'w') as f:
+        json.dump(dump, f)
+    os.rename(partial, filename)
+
+    dumps = sorted(name for name in os.listdir(directory)
+        if name.endswith('.json'))
+    for name in dumps[:-SlowRequests.keep or None]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            # Another worker got there first.
+            pass
+    return filename
+
+
+def _sampler():
+    """Starts this process's sampler thread, once per process: a worker
+    forked from a preloaded app doesn't inherit the parent's."""
+    global _sampler_pid
+    if _sampler_pid == os.getpid():
+        return
+    with _lock:
+        if _sampler_pid == os.getpid():
+            return
+        _sampler_pid = os.getpid()
+        _requests.clear()
+        _active.clear()
+        thread = threading.Thread(target=_sample)
+        thread.daemon = True
+        thread.start()
+
+
+def _sample():
+    delay = SlowRequests.interval
+    while True:
+        _active.wait()
+        time.sleep(delay)
+        # Module globals are None once the interpreter is shutting down.
+        if SlowRequests is None:
+            return
+        delay = SlowRequests.interval
+        if SlowRequests.threshold is None:
+            continue
+        now = default_timer()
+        with _lock:
+            slow = [(ident, request) for ident, request in _requests.items()
+                if now - request['started'] >= SlowRequests.threshold]
+            oldest = min([request['started']
+                for request in _requests.values()] or [now])
+        if not slow:
+            delay = max(delay, oldest + SlowRequests.threshold - now)
+            continue
+        frames = sys._current_frames()
+        for ident, request in slow:
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = _stack(frame)
+            with _lock:
+                request['samples'] += 1
+                request['stacks'][stack] = \
+                    request['stacks'].get(stack, 0) + 1
+        del frames
+
+
+def _stack(frame):
+    """The frames from ``frame`` out, outermost first."""
+    stack = []
+    while frame is not None and len(stack) < MAX_DEPTH:
+        code = frame.f_code
+        if code.co_filename not in _filenames:
+            _filenames[code.co_filename] = os.path.abspath(code.co_filename)
+        stack.append('%s:%d:%s' % (_filenames[code.co_filename],
+            frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def load(directory):
+    dumps = []
+    if not os.path.isdir(directory):
+        return dumps
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            dumps.append(json.load(open(os.path.join(directory, name))))
+        except (IOError, ValueError):
+            # Rotated away, or not ours.
+            continue
+    return dumps
+
+
+def summarize(directory, top=10):
+    """Lines reporting the slowest endpoints in the samples saved to
+    ``directory``, and the call sites they spent their time in: where the
+    samples were taken, and the innermost wire code calling it."""
+    dumps = load(directory)
+    if not dumps:
+        return ['No slow requests saved in %s.' % directory]
+
+    endpoints = {}
+    innermost = {}
+    wire = {}
+    total = 0
+    for dump in dumps:
+        endpoints.setdefault(dump['endpoint'], []).append(dump['duration'])
+        for stack in dump['stacks']:
+            frames = stack['frames']
+            count = stack['count']
+            total += count
+            if frames:
+                innermost[frames[-1]] = innermost.get(frames[-1], 0) + count
+            for frame in reversed(frames):
+                if frame.startswith(_package + os.sep):
+                    wire[frame] = wire.get(frame, 0) + count
+                    break
+
+    lines = ['%d slow requests, %d samples.' % (len(dumps), total), '']
+    lines.append('%-40s %6s %10s %10s' % ('endpoint', 'count', 'mean ms',
+        'max ms'))
+    ordered = sorted(endpoints.items(), key=lambda e: max(e[1]),
+        reverse=True)
+    for endpoint, durations in ordered[:top]:
+        lines.append('%-40s %6d %10.1f %10.1f' % (endpoint, len(durations),
+            sum(durations) / len(durations) * 1000, max(durations) * 1000))
+
+    for title, sites in [('Sampled in', innermost), ('Called from', wire)]:
+        lines.append('')
+        lines.append('%-7s %s' % ('samples', title))
+        ordered = sorted(sites.items(), key=lambda s: s[1], reverse=True)
+        for site, count in ordered[:top]:
+            lines.append('%6.1f%% %s' % (count * 100.0 / total,
+                _relative(site)))
+    return lines
+
+
+def _relative(frame):
+    filename, line, name = frame.rsplit(':', 2)
+    if filename.startswith(_package + os.sep):
+        filename = os.path.relpath(filename, os.path.dirname(_package))
+    return '%s:%s %s' % (filename, line, name)
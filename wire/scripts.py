@@ -0,0 +1,147 @@
+"""Lua scripts for model changes that touch several keys at once.
+
+Each script runs atomically, in one round-trip. ``load`` registers them all
+with SCRIPT LOAD when the app starts, and ``call`` runs them by EVALSHA,
+loading a script again if Redis has lost it since (NOSCRIPT).
+"""
+import hashlib
+
+from redis.exceptions import NoScriptError
+
+SCRIPTS = {}
+
+# KEYS: event attendees, event maybes, user attending, user maybe
+# ARGV: user key, event id, new state
+# Returns how many of the event's sets changed.
+SCRIPTS['rsvp'] = """
+local user, event, state = ARGV[1], ARGV[2], ARGV[3]
+local changed
+if state == 'attending' then
+    changed = redis.call('SADD', KEYS[1], user) +
+        redis.call('SREM', KEYS[2], user)
+    redis.call('SADD', KEYS[3], event)
+    redis.call('SREM', KEYS[4], event)
+elseif state == 'maybe' then
+    changed = redis.call('SADD', KEYS[2], user) +
+        redis.call('SREM', KEYS[1], user)
+    redis.call('SADD', KEYS[4], event)
+    redis.call('SREM', KEYS[3], event)
+else
+    changed = redis.call('SREM', KEYS[1], user) +
+        redis.call('SREM', KEYS[2], user)
+    redis.call('SREM', KEYS[3], event)
+    redis.call('SREM', KEYS[4], event)
+end
+return changed
+"""
+
+# KEYS: user contacts, username key of the contact, contact followers
+# ARGV: user key, contact username, contact key
+# Returns 1 when added, 0 if already a contact and -1 if the username no
+# longer belongs to the contact.
+SCRIPTS['add_contact'] = """
+for _, username in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    if username == ARGV[2] then
+        return 0
+    end
+end
+if redis.call('GET', KEYS[2]) ~= ARGV[3] then
+    return -1
+end
+redis.call('LPUSH', KEYS[3], ARGV[1])
+redis.call('LPUSH', KEYS[1], ARGV[2])
+redis.call('SORT', KEYS[1], 'ALPHA', 'STORE', KEYS[1])
+return 1
+"""
+
+# KEYS: thread recipients, then the threads, inbox, unreads and unread total
+#       of each recipient, in the order of ARGV
+# ARGV: thread key, unreads to give new recipients, inbox score for new
+#       recipients, recipient keys...
+# Returns how many recipients were added.
+SCRIPTS['sync_recipients'] = """
+local thread = ARGV[1]
+local current = {}
+for _, key in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    current[key] = true
+end
+local added = 0
+for i = 4, #ARGV do
+    local recipient = ARGV[i]
+    local k = 2 + (i - 4) * 4
+    if not current[recipient] then
+        current[recipient] = true
+        redis.call('RPUSH', KEYS[1], recipient)
+        redis.call('LPUSH', KEYS[k], thread)
+        redis.call('ZADD', KEYS[k + 1], ARGV[3], thread)
+        redis.call('HINCRBY', KEYS[k + 2], thread, ARGV[2])
+        redis.call('INCRBY', KEYS[k + 3], ARGV[2])
+        added = added + 1
+    end
+end
+return added
+"""
+
+# KEYS: user unreads, user unread total
+# ARGV: thread key
+# Returns the thread's unread count, now taken off the total.
+SCRIPTS['clear_unreads'] = """
+local count = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+redis.call('HDEL', KEYS[1], ARGV[1])
+if count ~= 0 then
+    redis.call('DECRBY', KEYS[2], count)
+end
+return count
+"""
+
+# KEYS: update, author timeline, author updates, conversation, author
+#       pulled index, event comments, rendered fragments, then the timeline
+#       and mentions of each mentioned user
+# ARGV: update key, '1' for an event comment
+# Followers' timelines are left to the caller, there may be a great many.
+SCRIPTS['delete_update'] = """
+local update = ARGV[1]
+if ARGV[2] == '1' then
+    redis.call('LREM', KEYS[6], 0, update)
+else
+    redis.call('LREM', KEYS[2], 0, update)
+    redis.call('LREM', KEYS[3], 0, update)
+    redis.call('ZREM', KEYS[5], update)
+end
+for i = 8, #KEYS do
+    redis.call('LREM', KEYS[i], 0, update)
+end
+redis.call('LREM', KEYS[4], 0, update)
+redis.call('DEL', KEYS[7])
+return redis.call('DEL', KEYS[1])
+"""
+
+# KEYS: list
+# ARGV: length to keep
+# Returns the entries trimmed off the end, in list order.
+SCRIPTS['trim_list'] = """
+local keep = tonumber(ARGV[1])
+local trimmed = redis.call('LRANGE', KEYS[1], keep, -1)
+if #trimmed > 0 then
+    redis.call('LTRIM', KEYS[1], 0, keep - 1)
+end
+return trimmed
+"""
+
+SHAS = dict((name, hashlib.sha1(source).hexdigest())
+    for name, source in SCRIPTS.items())
+
+
+def load(redis):
+    """Registers every script with Redis."""
+    for name, source in SCRIPTS.items():
+        redis.script_load(source)
+
+
+def call(redis, name, keys=[], args=[]):
+    keys_and_args = list(keys) + list(args)
+    try:
+        return redis.evalsha(SHAS[name], len(keys), *keys_and_args)
+    except NoScriptError:
+        redis.script_load(SCRIPTS[name])
+        return redis.evalsha(SHAS[name], len(keys), *keys_and_args)
@@ -4,9 +4,74 @@ SECRET_KEY = ''
 LOG_LOCATION = 'error.log'
 UPLOADED_AVATARS_DEST = 'wire/static/img/avatar'
 UPLOADED_IMAGES_DEST = 'wire/static/img/event'
+# Uploads wait here to be resized by a pool of this many threads, each
+# running one ImageMagick convert.
+UPLOADS_STAGING_DEST = 'wire/uploads/staging'
+IMAGE_PROCESSES = 2
+IMAGE_QUALITY = 85
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
 REDIS_DB = 0
+# Shared connection pool, per worker process.
+REDIS_MAX_CONNECTIONS = 50
+REDIS_SOCKET_TIMEOUT = 5
+REDIS_CONNECT_TIMEOUT = 2
+# Seconds a pooled connection may sit idle before it is PINGed on reuse.
+REDIS_HEALTH_CHECK_INTERVAL = 30
+# Password hashing: 'p' is PBKDF2-SHA256, 'w' the whirlpool of older hashes.
+# Hashes are strengthened to this on the next successful login.
+HASHER_ALGORITHM = 'p'
+HASHER_STRENGTH = 15
+# Processes to hash passwords in; 0 hashes inside the request. A request
+# still waits for its hash either way, so a pool only frees up workers of
+# an async worker class, like gevent, and each worker forks its own.
+HASHER_PROCESSES = 0
+# Updates shown per timeline page.
+TIMELINE_PAGE_SIZE = 30
+# Updates kept in each timeline, updates and mentions list. Lists are let
+# grow this many more before their oldest updates are moved to an archive,
+# which pages carry on into. None lets lists grow.
+TIMELINE_CAP = 1000
+TIMELINE_TRIM_BATCH = 100
+# Server archives are kept on, say one with more disk than memory. None
+# keeps them on the main server.
+ARCHIVE_REDIS_HOST = None
+ARCHIVE_REDIS_PORT = 6379
+ARCHIVE_REDIS_DB = 0
+# Push new updates to followers from `manage.py fanout-worker` instead of
+# inside the request. Only turn this on once the worker is running.
+FANOUT_ASYNC = False
+# Users with more followers than this have their updates merged into
+# timelines when read instead of pushed. None pushes to everyone.
+FANOUT_PULL_THRESHOLD = 5000
+# Messages shown at a time in a thread.
+THREAD_PAGE_SIZE = 30
+# Threads listed per inbox page.
+INBOX_PAGE_SIZE = 30
+# Events listed per page.
+EVENTS_PAGE_SIZE = 20
+# Usernames offered by the contact autocomplete.
+CONTACT_SEARCH_LIMIT = 10
+# User profiles each worker keeps in memory, and for how many seconds at
+# most. 0 turns the cache off.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60
+# Seconds rendered updates are cached for, 0 to render every time. Bump
+# the version whenever update.html changes.
+FRAGMENT_CACHE_TTL = 60 * 60 * 24
+FRAGMENT_VERSION = 1
+# Requests running for longer than this many seconds have their stack
+# sampled every interval, and the samples saved to the directory, which
+# keeps the newest files. None turns sampling off.
+SLOW_REQUEST_THRESHOLD = 1.0
+SLOW_REQUEST_INTERVAL = 0.01
+SLOW_REQUEST_DIR = 'slow_requests'
+SLOW_REQUEST_KEEP = 200
+# Serve /metrics and /status/*, and the X-Redis header in debug mode, to
+# requests made straight to a worker from one of these addresses. Requests
+# through a proxy, which sets X-Forwarded-For, are refused.
+STATUS_ENDPOINTS = False
+STATUS_ADDRESSES = ['127.0.0.1', '::1']
 # Get a key from http://code.google.com/apis/maps/signup.html
 GMAPS_KEY = ''
 STATIC_PATH = '/'
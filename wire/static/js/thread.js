@@ -1,21 +1,60 @@
-$(function() {
-    $('article.message header .opts a').hide();
-    $('article.message').hover(function() {
+function bindOpts(context) {
+    $('article.message header .opts a', context).hide();
+    $('article.message', context).hover(function() {
         $('header .opts a', this).show();
     }, function() {
         $('header .opts a', this).hide();
     })
+}
+
+function renderMessages(context) {
+    converter = new Showdown.converter();
+    $('article.message div.plain', context).each(function() {
+        $(this).html(converter.makeHtml($(this).text()));
+    });
+    // Older messages fetched after the thread was decrypted.
+    if(window.passphrase) {
+        $('article.message div.aes256', context).each(function() {
+            text = sjcl.decrypt(window.passphrase, $(this).text());
+            $(this).html(converter.makeHtml(text));
+            $(this).removeClass('aes256');
+            $(this).addClass('plain');
+        });
+    }
+}
+
+$(function() {
+    bindOpts(document);
 
     $.getJSON('/async/address-book', function(data) {
         $("#addrecip").autocomplete(data, {
             multiple: true,
             mustMatch: false,
             autoFill: true
-        });        
+        });
     });
 
-    converter = new Showdown.converter();
-    $('article.message div.plain').each(function() {
-        $(this).html(converter.makeHtml($(this).text()));
-    }); 
-});
\ No newline at end of file
+    renderMessages(document);
+
+    var messages = $('div#messages');
+    var more = messages.attr('data-more');
+    var loading = false;
+    $('p.older a').click(function(e) {
+        e.preventDefault();
+        if(loading || !more) {
+            return;
+        }
+        loading = true;
+        $.getJSON(more, function(data) {
+            var page = $('<div>' + data.html + '</div>');
+            bindOpts(page);
+            renderMessages(page);
+            $('p.older').after(page.children());
+            more = data.more;
+            if(!more) {
+                $('p.older').hide();
+            }
+            loading = false;
+        });
+    });
+});
@@ -1,8 +1,38 @@
-$(function() {
-    $('article.message header .opts a').hide();
-    $('article.message').hover(function() {
+function bindOpts(context) {
+    $('article.message header .opts a', context).hide();
+    $('article.message', context).hover(function() {
         $('header .opts a', this).show();
     }, function() {
         $('header .opts a', this).hide();
     })
-})
\ No newline at end of file
+}
+
+$(function() {
+    bindOpts(document);
+
+    var timeline = $('div.timeline');
+    var more = timeline.attr('data-more');
+    var loading = false;
+    if(!more) {
+        return;
+    }
+    $('p.older').hide();
+
+    $(window).scroll(function() {
+        if(loading || !more) {
+            return;
+        }
+        if($(window).scrollTop() + $(window).height() <
+            $(document).height() - 400) {
+            return;
+        }
+        loading = true;
+        $.getJSON(more, function(data) {
+            var page = $('<div>' + data.html + '</div>');
+            bindOpts(page);
+            timeline.append(page.children());
+            more = data.more;
+            loading = false;
+        });
+    });
+});
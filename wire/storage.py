@@ -0,0 +1,166 @@
+"""Users, updates, messages, events and thread data, stored as hashes.
+
+Each entity is a Redis hash with a field per attribute, so a caller that
+needs one attribute, like an event's name, HMGETs just that field, and
+small entities are kept in Redis's compact hash encoding (raise
+``hash-max-ziplist-value`` in redis.conf to 256 so that update texts,
+messages and password hashes fit it).
+
+String attributes are stored as they are; the others, listed in
+``JSON_FIELDS``, are JSON encoded. String attributes that are None are
+left out, and so are missing from what ``load`` returns.
+
+Entities used to be JSON strings. Until ``manage.py migrate-storage`` has
+converted them all, reads of an unconverted key fall back to GET, at the
+cost of a second round-trip.
+"""
+import json
+import re
+
+from redis.exceptions import ResponseError
+
+KEYS = {
+    'user': 'user:%s',
+    'update': 'update:%s',
+    'message': 'message:%s',
+    'event': 'event:%s',
+    'thread': 'thread:%s:data',
+}
+JSON_FIELDS = {
+    'user': set(),
+    'update': set(['mentions', 'hashes', 'respond', 'conversation', 'event']),
+    'message': set(['thread']),
+    'event': set(['conversation']),
+    'thread': set(),
+}
+PATTERNS = dict((kind, re.compile('^%s$' % key.replace('%s', '\d+')))
+    for kind, key in KEYS.items())
+
+
+def key(kind, id):
+    return KEYS[kind] % id
+
+
+def encode(kind, data):
+    fields = {}
+    for field, value in data.items():
+        if field in JSON_FIELDS[kind]:
+            fields[field] = json.dumps(value)
+        elif value is None:
+            continue
+        elif isinstance(value, unicode):
+            fields[field] = value.encode('UTF-8')
+        else:
+            fields[field] = str(value)
+    return fields
+
+
+def decode(kind, fields):
+    data = {}
+    for field, value in fields.items():
+        if value is None:
+            continue
+        if field in JSON_FIELDS[kind]:
+            data[field] = json.loads(value)
+        else:
+            data[field] = value.decode('UTF-8')
+    return data
+
+
+def save(redis, kind, id, data):
+    """Replaces the entity, as SET did, in one round-trip."""
+    k = key(kind, id)
+    pipe = redis.pipeline()
+    pipe.delete(k)
+    pipe.hmset(k, encode(kind, data))
+    pipe.execute()
+
+
+def load(redis, kind, id, fields=None):
+    """Returns the entity's ``fields``, or all of them, as a dict, or None
+    if it doesn't exist."""
+    return load_many(redis, kind, [id], fields)[0]
+
+
+def load_many(redis, kind, ids, fields=None):
+    """Loads many entities in one round-trip, returning a dict or None for
+    each of ``ids``, in order. An entity that has none of ``fields`` is
+    taken not to exist."""
+    ids = list(ids)
+    if not ids:
+        return []
+    pipe = redis.pipeline(transaction=False)
+    for id in ids:
+        if fields:
+            pipe.hmget(key(kind, id), fields)
+        else:
+            pipe.hgetall(key(kind, id))
+    replies = pipe.execute(raise_on_error=False)
+
+    results = []
+    unconverted = []
+    for i, reply in enumerate(replies):
+        if isinstance(reply, ResponseError):
+            unconverted.append(i)
+            results.append(None)
+            continue
+        if fields:
+            reply = dict(zip(fields, reply))
+        if not any(value is not None for value in reply.values()):
+            results.append(None)
+            continue
+        results.append(decode(kind, reply))
+
+    if unconverted:
+        blobs = redis.mget([key(kind, ids[i]) for i in unconverted])
+        for i, blob in zip(unconverted, blobs):
+            if blob is None:
+                continue
+            data = json.loads(blob)
+            if fields:
+                data = dict((field, data[field]) for field in fields
+                    if field in data)
+            results[i] = data
+    return results
+
+
+def migrate(redis, batch_size=500):
+    """Converts entities still stored as JSON strings to hashes, SCANning
+    ``batch_size`` keys at a time, while the app keeps running. Returns how
+    many were converted."""
+    r = redis
+    converted = 0
+    cursor = 0
+    while True:
+        cursor, keys = r.scan(cursor, count=batch_size)
+        batches = {}
+        for k in keys:
+            for kind, pattern in PATTERNS.items():
+                if pattern.match(k):
+                    batches.setdefault(kind, []).append(k)
+        for kind, keys in batches.items():
+            pipe = r.pipeline(transaction=False)
+            for k in keys:
+                pipe.type(k)
+            strings = [k for k, type in zip(keys, pipe.execute())
+                if type == 'string']
+            if not strings:
+                continue
+
+            def convert(pipe):
+                # MGET skips keys that have become hashes since.
+                blobs = pipe.mget(strings)
+                pipe.multi()
+                count = 0
+                for k, blob in zip(strings, blobs):
+                    if blob is None:
+                        continue
+                    pipe.delete(k)
+                    pipe.hmset(k, encode(kind, json.loads(blob)))
+                    count += 1
+                return count
+            converted += r.transaction(convert, *strings,
+                value_from_callable=True)
+        if cursor == 0:
+            break
+    return converted
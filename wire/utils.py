@@ -1,5 +1,9 @@
-import json
+import hashlib
+import hmac
 import math
+import multiprocessing
+import os
+import time
 from base64 import b64encode
 from binascii import b2a_hex
 from os import urandom
@@ -7,6 +11,8 @@ from os import urandom
 import redis
 import whirlpool
 
+from wire import storage
+
 
 class Auth:
     def __init__(self, redis):
@@ -14,6 +20,7 @@ class Auth:
         self.user = False
 
     def attempt(self, username, password):
+        from wire import cache
         from wire.models import User
 
         r = self.redis
@@ -22,11 +29,15 @@ class Auth:
             raise AuthError()
 
         key = r.get('username:%s' % username)
-        data = json.loads(r.get('user:%s' % key))
+        data = storage.load(r, 'user', key)
         try:
             h.check(password, data['password'])
         except HashMismatch:
             raise AuthError()
+        if h.needs_rehash(data['password']):
+            data['password'] = h.hash(password)
+            storage.save(r, 'user', key, data)
+            cache.invalidate(r, key, username)
         self.user = User(data=data, redis=r, key=key)
     def set_user(self, user):
         self.user = user
@@ -43,41 +54,173 @@ class DeniedError(AuthError):
 
 
 class Hasher:
-    def __init__(self, strength=16):
-        self._strength = strength
+    """Hashes passwords as ``$algorithm$strength$salt$hash``.
+
+    Algorithms are ``w`` (2^strength rounds of whirlpool, what older hashes
+    use) and ``p`` (PBKDF2-SHA256 with 2^strength iterations). Hashes are
+    worked out inline, or in a pool of ``processes`` processes. The caller
+    waits for its hash either way, so the pool only helps async workers,
+    whose other requests can run in the meantime.
+    """
+    # Defaults for new hashes, set from config by create_app.
+    algorithm = 'p'
+    strength = 15
+    processes = 0
+    timeout = 60
+    algorithms = ['w', 'p']
+
+    def __init__(self, strength=None, algorithm=None):
+        self._strength = strength or self.strength
+        self._algorithm = algorithm or self.algorithm
 
     def hash(self, password, salt=False, encode=True):
         if salt is False:
             salt = urandom(32)
         if encode:
             salt = b64encode(salt)
-        return "$w$%s$%s$%s" % (
+        return "$%s$%s$%s$%s" % (
+            self._algorithm,
             self._strength,
             salt,
-            self._hash_multi(salt + password, self._strength)
+            self._derive(self._algorithm, password, salt, self._strength)
         )
 
     def check(self, attempt, h):
         bits = h.split("$")
         try:
-            if self._hash_multi(bits[3] + attempt, float(bits[2])) != bits[4]:
+            digest = self._derive(bits[1], attempt, bits[3],
+                int(float(bits[2])))
+            if not hmac.compare_digest(str(digest), str(bits[4])):
                 raise HashMismatch()
-        except IndexError:
+        except (IndexError, ValueError):
             raise HashMismatch()
 
-    def _hash_multi(self, string, strength):
+    def needs_rehash(self, h):
+        bits = h.split("$")
+        return bits[1] != self._algorithm or \
+            int(float(bits[2])) != self._strength
+
+    def _derive(self, algorithm, password, salt, strength):
+        if self.processes < 1:
+            return derive(algorithm, password, salt, strength)
+        return _hasher_pool(self.processes).apply_async(derive,
+            (algorithm, password, salt, strength)).get(self.timeout)
+
+
+def derive(algorithm, password, salt, strength):
+    if algorithm == 'w':
+        string = salt + password
         for i in range(int(math.pow(2, strength))):
             string = b2a_hex(whirlpool.hash(string))
         return string
 
+    if isinstance(password, unicode):
+        password = password.encode('UTF-8')
+    salt = str(salt)
+    if algorithm == 'p':
+        return b2a_hex(hashlib.pbkdf2_hmac('sha256', password, salt,
+            2 ** strength))
+    raise ValueError("Unknown hash algorithm %s." % algorithm)
+
+
+_pool = None
+_pool_pid = None
+
+
+def _hasher_pool(processes):
+    """The process pool hashes are worked out in, one per worker process."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = multiprocessing.Pool(processes)
+        _pool_pid = os.getpid()
+    return _pool
+
 
 class HashMismatch(Exception):
     pass
 
 
 def autoinc(redis, key):
-    key = "_incs:%s" % key
-    if not redis.exists(key):
-        redis.set(key, 0)
-
-    return redis.incr(key)
+    """Allocates the next id for ``key``. INCR starts a missing counter at
+    zero, so this is one atomic call."""
+    return redis.incr("_incs:%s" % key)
+
+
+class ConnectionPool(redis.ConnectionPool):
+    """Redis connection pool shared by every request in a process.
+
+    Safe to build before gunicorn forks its workers (``--preload``): a
+    forked child never shuts down the sockets it inherited, it drops them
+    and starts a fresh pool of its own. Connections that sat idle for
+    longer than ``health_check_interval`` seconds are PINGed before they
+    are handed out again.
+    """
+    def __init__(self, health_check_interval=0, **kwargs):
+        self.health_check_interval = health_check_interval
+        redis.ConnectionPool.__init__(self, **kwargs)
+
+    def reset(self):
+        redis.ConnectionPool.reset(self)
+        self._idle_since = {}
+        self._checkouts = 0
+        self._health_check_failures = 0
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            with self._check_lock:
+                if self.pid == os.getpid():
+                    return
+                # Calling disconnect() here would shutdown() the parent's
+                # sockets as well, so just let go of them.
+                self.reset()
+
+    def get_connection(self, command_name, *keys, **options):
+        connection = redis.ConnectionPool.get_connection(self,
+            command_name, *keys, **options)
+        self._checkouts += 1
+        idle_since = self._idle_since.pop(connection, None)
+        if self.health_check_interval and idle_since and \
+                time.time() - idle_since > self.health_check_interval:
+            self._check_health(connection)
+        return connection
+
+    def _check_health(self, connection):
+        try:
+            connection.send_command('PING')
+            connection.read_response()
+        except (redis.ConnectionError, redis.TimeoutError):
+            self._health_check_failures += 1
+            connection.disconnect()
+
+    def release(self, connection):
+        redis.ConnectionPool.release(self, connection)
+        if connection.pid == self.pid:
+            self._idle_since[connection] = time.time()
+
+    def disconnect(self):
+        redis.ConnectionPool.disconnect(self)
+        self._idle_since = {}
+
+    def stats(self):
+        self._checkpid()
+        return {
+            'pid': self.pid,
+            'max_connections': self.max_connections,
+            'created_connections': self._created_connections,
+            'in_use_connections': len(self._in_use_connections),
+            'available_connections': len(self._available_connections),
+            'checkouts': self._checkouts,
+            'health_check_failures': self._health_check_failures
+        }
+
+
+def create_redis_pool(config):
+    return ConnectionPool(
+        host=config['REDIS_HOST'],
+        port=config['REDIS_PORT'],
+        db=config['REDIS_DB'],
+        max_connections=config['REDIS_MAX_CONNECTIONS'],
+        socket_timeout=config['REDIS_SOCKET_TIMEOUT'],
+        socket_connect_timeout=config['REDIS_CONNECT_TIMEOUT'],
+        health_check_interval=config['REDIS_HEALTH_CHECK_INTERVAL']
+    )